@@ -1,55 +1,111 @@
 # coding: utf8
-import io
+import time
+_module_start = time.perf_counter()
+
 import os
+import re
 import sys
 import json
 import shutil
 import datetime
 import tempfile
+import threading
+import multiprocessing
+import importlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
-from docx2pdf import convert
-from fpdf import FPDF, HTMLMixin
-from fpdf.fonts import FontFace
-from fpdf.enums import XPos, YPos
-from PyPDF2 import PdfReader, PdfWriter, PdfMerger
-from arabic_reshaper import reshape
-from bidi_display import get_display
-#from bidi.algorithm import get_display
-
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
+# Conversion, cover/TOC and stamping dependencies (docx2pdf, fpdf, PyPDF2,
+# reportlab, arabic_reshaper) are imported on first use, so a job only pays
+# for what it needs
+from doc_registry import DocumentRegistry
+from docx_cache import DocxCache
+from build_manifest import BuildManifest
+from font_cache import add_font
+from progress import ProgressChannel, pipe_writer
+from metrics import PhaseMetrics
 
 PIPE_PATH = "\\\\.\\pipe\\pdfpipe"
-
-class MyFPDF(FPDF, HTMLMixin):
-  pass
+CONVERT_WORKERS = 4
+# Characters arabic_reshaper can change; text without them is passed through as is
+ARABIC_LETTERS = re.compile("[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF\uFB50-\uFDFF\uFE70-\uFEFF\u200D]")
+RTL_CACHE_SIZE = 4096  # Displayed strings kept per process, shared by worker jobs
+LAZY_MODULES = ["docx2pdf", "fpdf", "PyPDF2", "reportlab.pdfgen.canvas", "arabic_reshaper", "bidi_display", "page_stamp", "image_optimizer", "linearize"]
 
 def docx_convert(doc_path, pdf_dir):
-  """Convert DOCX file to PDF"""
+  """Convert DOCX file to PDF; returns its path and the wall and CPU seconds it took"""
+  start, start_cpu = time.perf_counter(), time.process_time()
+  from docx2pdf import convert
   doc_file = os.path.basename(doc_path)
   pre, ext = os.path.splitext(doc_file)
   pdf_file = pre + ".pdf"
-  
+
   pdf_path = os.path.join(pdf_dir, pdf_file)
 
-  convert(doc_path, pdf_path)
-  return pdf_path
-
-def page_number(index, draft=False):
-  """Create a page with page number and optional draft watermark"""
-  packet = io.BytesIO()
-  can = canvas.Canvas(packet, pagesize=A4)
-  page_width, page_height = A4
-  can.drawString(280, 20, "- " + str(index) + " -")
-  if draft:
-    draft_path = os.path.join(base_dir, "assets", "draft.png")
-    can.drawImage(draft_path, x=0, y=0, width=page_width, height=page_height, mask='auto')
-  can.save()
-  packet.seek(0)
-  return PdfReader(packet).pages[0]
+  try:
+    convert(doc_path, pdf_path)
+  except NotImplementedError:
+    # docx2pdf needs Word (Windows/macOS); headless Linux converts with LibreOffice,
+    # with a profile per conversion so parallel instances don't lock each other out
+    import subprocess
+    from pathlib import Path
+    soffice = shutil.which("soffice") or shutil.which("libreoffice")
+    if not soffice:
+      raise
+    profile = Path(pdf_dir, "lo_profile").absolute().as_uri()
+    subprocess.run([soffice, "-env:UserInstallation=" + profile, "--headless", "--convert-to", "pdf",
+                    "--outdir", pdf_dir, doc_path], check=True, capture_output=True)
+  return pdf_path, time.perf_counter() - start, time.process_time() - start_cpu
 
-def rtl_line(line, max_len=27):
-  """Process RTL text line with word wrapping and BiDi display"""
+def shape(text):
+  """Apply Arabic shaping when the text has letters it can change"""
+  if ARABIC_LETTERS.search(text):
+    from arabic_reshaper import reshape
+    text = reshape(text)
+  return text
+
+class DisplayCache:
+  """Displayed strings of the process by (text, max_len), least recently used dropped first.
+
+  Unlike an lru_cache it can be looked up and filled from outside, so batch
+  callers (rtl_lines) share it with display_text.
+  """
+
+  def __init__(self, maxsize):
+    self.entries = OrderedDict()
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+
+  def lookup(self, key):
+    result = self.entries.get(key)
+    if result is None:
+      self.misses += 1
+    else:
+      self.entries.move_to_end(key)
+      self.hits += 1
+    return result
+
+  def store(self, key, result):
+    self.entries[key] = result
+    if len(self.entries) > self.maxsize:
+      self.entries.popitem(last=False)
+
+display_cache = DisplayCache(RTL_CACHE_SIZE)
+
+def display_text(text, max_len=None):
+  """Shape (when Arabic) and reorder text for display, word wrapped first if max_len is given"""
+  key = (text, max_len)
+  result = display_cache.lookup(key)
+  if result is None:
+    from bidi_display import get_display
+    #from bidi.algorithm import get_display
+    result = get_display(shape(text if max_len is None else wrap_line(text, max_len)))
+    display_cache.store(key, result)
+  return result
+
+def wrap_line(line, max_len=27):
+  """Word wrap a line into rows of at most max_len characters"""
   lines=[]
   line_num=-1
   char_num=max_len
@@ -64,174 +120,560 @@ def rtl_line(line, max_len=27):
   new_line = ""
   for line in lines:
     new_line += " " + " ".join(line) + "\n"
-  new_line = new_line[:-1]
-  return get_display(reshape(new_line))
+  return new_line[:-1]
 
+def rtl_line(line, max_len=27):
+  """Process RTL text line with word wrapping and BiDi display"""
+  return display_text(line, max_len)
+
+def rtl_lines(lines, max_len=27):
+  """rtl_line for a column of lines; those not in the display cache are reordered together in one batch"""
+  from bidi_display import get_display_many
+  lines = list(lines)
+  displayed = {}
+  for line in lines:
+    if line not in displayed:
+      displayed[line] = display_cache.lookup((line, max_len))
+  missing = [line for line, result in displayed.items() if result is None]
+  for line, result in zip(missing, get_display_many(shape(wrap_line(line, max_len)) for line in missing)):
+    displayed[line] = result
+    display_cache.store((line, max_len), result)
+  return [displayed[line] for line in lines]
+
+def rtl_cache_info():
+  """Hits and misses of the display cache"""
+  return {"hits": display_cache.hits, "misses": display_cache.misses}
+
+class CoverPages:
+  """Attachment cover pages of a job, rendered into a single document with the font loaded once"""
+
+  def __init__(self):
+    from fpdf import FPDF
+    self.pdf = FPDF(orientation="P", unit="mm", format="A4")
+    self.pdf.set_top_margin(40)
+    add_font(self.pdf, 'David', os.path.join(base_dir, "fonts", "David.ttf"))
+
+  def add(self, appx_num, title, page):
+    """Render one cover page; returns its first page index and page count in the document"""
+    pdf = self.pdf
+    first = pdf.page
+    pdf.add_page()
+
+    appx_title = "נספח " + str(appx_num)
+    pdf.set_font("David", "U", size=36)
+    pdf.multi_cell(0, 14, txt=rtl_line(appx_title), border=0, align="C")
+    pdf.set_font("David", size=36)
+    pdf.cell(0, 15, txt="", ln=1, border=0, align="C")
+    pdf.multi_cell(0, 14, txt=rtl_line(title), border=0, align="C")
+    pdf.cell(0, 45, txt="", ln=1, border=0, align="C")
+    pdf.multi_cell(0, 14, txt=rtl_line("עמ' " + str(page)), border=0, align="C")
+    return first, pdf.page - first
+
+  def output(self, pdf_path):
+    self.pdf.output(pdf_path)
+
+def toc_page(pdf_path, toc):
+  """Render the attachments table of contents"""
+  from fpdf import FPDF
+  from fpdf.enums import XPos, YPos
+  pdf = FPDF(orientation="P", unit="mm", format="A4")
+  pdf.set_top_margin(20)
+  pdf.set_left_margin(18)
+  add_font(pdf, 'David', os.path.join(base_dir, "fonts", "David.ttf"))
+  add_font(pdf, 'Davidbd', os.path.join(base_dir, "fonts", "davidbd.ttf"))
+  pdf.add_page()
+  pdf.set_font("Davidbd", "U", size=18)
+  pdf.cell(0, 10, txt="תוכן עניינים"[::-1], new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="C")
+  pdf.cell(0, 7, txt="", border=0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="C")
+  pdf.set_font("Davidbd", size=14)
+  headers = ["עמ'", "שם הנספח", "מס'"]
+  table_data = [[display_text(header) for header in headers]]
+  with pdf.table(table_data, first_row_as_headings=False, col_widths=(7, 86, 7), text_align="CENTER") as table:
+    pass
+  pdf.set_font("David", size=12)
+  titles = rtl_lines((title for _, title, _ in toc), 68)
+  rows = [[str(page), title, str(appx_num)] for (page, _, appx_num), title in zip(toc, titles)]
+  with pdf.table(rows, first_row_as_headings=False, line_height=pdf.font_size, col_widths=(7, 86, 7), text_align=("CENTER", "RIGHT", "CENTER"), padding=2) as table:
+    pass
+  pdf.output(pdf_path)
 
-def send_message(fifo, message, phase, step, total):
-  """Send progress message through FIFO pipe"""
-  if fifo:
-    status = {'message': message, 'phase': phase, 'step': step, 'total': total}
-    status_str = json.dumps(status)
-    os.write(fifo, bytes(status_str, 'utf-8'))
-  
 def generate(fifo, docs):
   """Main PDF generation function"""
   if "output" not in docs or not isinstance(docs["output"], dict) or "path" not in docs["output"] or not docs["output"]["path"].endswith(".pdf"):
     return {"status": "error", "msg": "קובץ הפלט לא תקין"}
+  if docs.get("streaming", False) and docs.get("linearize", False):
+    # Linearizing re-reads the whole finished file into memory, which is what streaming avoids
+    return {"status": "error", "msg": "לא ניתן לשלב streaming עם linearize"}
 
   # Create temp directory in user's temp folder or system temp
   temp_dir = tempfile.mkdtemp(prefix="dindocs_")
   result = {"status": "success"}
+  rtl_start = rtl_cache_info()
+
+  metrics = None
+  profiler = None
 
-  pdfs = []
-  current_page = 0
-  merger = PdfMerger()
+  output_path = docs["output"]["path"]
+  temp_output = output_path + ".tmp"
+  linear_output = output_path + ".lin.tmp"
+  draft = "isDraft" in docs and docs["isDraft"]==True
+  registry = DocumentRegistry()
 
-  docx_count = sum(1 for attachment in docs["attachments"] if attachment["path"].endswith(".docx")) + int(docs["main"].endswith(".docx"))
-  total_steps = docx_count + 4
+  # Sources in document order, which is also the order they are converted
+  # in; a file used twice keeps its first label
+  labels = {docs["main"]: "המסמך הראשי"}
+  for appx_num, attachment in enumerate(docs["attachments"], 1):
+    labels.setdefault(attachment["path"], "נספח {}".format(appx_num))
+  docx_count = sum(1 for doc_path in labels if doc_path.endswith(".docx"))
+  total_steps = docx_count + 2
+  image_options = None
+  if docs.get("optimizeImages", False):
+    from image_optimizer import IMAGE_DPI, IMAGE_QUALITY
+    image_options = (docs.get("imageDpi") or IMAGE_DPI, docs.get("imageQuality") or IMAGE_QUALITY)
+    total_steps += 1
   current_step = 0
 
-  def send_message(message, phase, step):
-    if fifo:
+  # Progress goes to a callback (worker mode) or the named pipe as NDJSON,
+  # throttled and written off the generation thread
+  progress = None
+  if fifo:
+    progress = ProgressChannel(fifo if callable(fifo) else pipe_writer(fifo))
+
+  def send_message(message, phase, step, **extra):
+    if progress:
       status = {'message': message, 'phase': phase, 'step': step, 'total': total_steps}
-      status_str = json.dumps(status)
-      os.write(fifo, bytes(status_str, 'utf-8'))
+      status.update(extra)
+      progress.send(status)
 
-  try:
-    main_path = docs["main"]
-    if main_path.endswith(".docx"):
+  # DOCX conversions run on a bounded process pool and are started as early
+  # as possible; cover pages are rendered while they are in flight.
+  # Unchanged Word files are served from the persistent conversion cache.
+  converted_paths = {}
+  conversions = {}
+  digests = {}  # Content hash of each converted file, taken before converting
+  pending = {}
+  executor = None
+  cache = None
+  output_fp = None
+  if docs.get("docxCache", True):
+    try:
+      cache = DocxCache()
+    except OSError:
+      pass  # No usable cache folder, convert everything
+
+  def report_conversions():
+    nonlocal current_step
+    for future in [future for future in pending if future.done()]:
       current_step += 1
-      send_message("ממיר את המסמך הראשי לקובץ PDF", "converting", current_step)
-      main_path = docx_convert(main_path, temp_dir)
-    pdfs.append(main_path)
-    with open(main_path, "rb") as main_file:
-      read_pdf = PdfReader(main_file)
-      current_page = len(read_pdf.pages) + 3
+      send_message("ממיר את {} לקובץ PDF".format(pending.pop(future)), "converting", current_step, cache="miss")
 
+  def request_conversion(doc_path):
+    nonlocal current_step, executor
+    if doc_path in converted_paths or doc_path in conversions:
+      return
+    digest, cached_path = cache.lookup(doc_path, temp_dir) if cache else (None, None)
+    if cached_path:
+      converted_paths[doc_path] = cached_path
+      metrics.conversion(labels[doc_path], os.path.getsize(doc_path), "hit")
+      current_step += 1
+      send_message("{} נטען ממטמון ההמרות".format(labels[doc_path]), "converting", current_step, cache="hit")
+      return
+    if executor is None:
+      workers = docs.get("convertWorkers") or CONVERT_WORKERS
+      executor = ProcessPoolExecutor(max_workers=max(1, min(workers, docx_count)))
+    pdf_dir = os.path.join(temp_dir, "docx{}".format(len(conversions)))
+    os.mkdir(pdf_dir)
+    conversions[doc_path] = executor.submit(docx_convert, doc_path, pdf_dir)
+    digests[doc_path] = digest
+    pending[conversions[doc_path]] = labels[doc_path]
+
+  def source_pdf(doc_path):
+    if not doc_path.endswith(".docx"):
+      return doc_path
+    if doc_path not in converted_paths:
+      request_conversion(doc_path)
+    if doc_path not in converted_paths:
+      future = conversions[doc_path]
+      with metrics.phase("converting"):  # Only the time spent waiting on Word, not the overlapped part
+        report_conversions()
+        while not future.done():
+          wait(pending, return_when=FIRST_COMPLETED)
+          report_conversions()
+      pdf_path, seconds, cpu_seconds = future.result()
+      metrics.conversion(labels[doc_path], os.path.getsize(doc_path), "miss", seconds, cpu_seconds)
+      if cache:
+        cache.store(digests[doc_path], pdf_path)
+      converted_paths[doc_path] = pdf_path
+    return converted_paths[doc_path]
+
+  try:
+    # Wall/CPU time, pages and bytes per phase go to result["metrics"]; traced
+    # memory and a cProfile dump of the run are opt-in, as both slow it down.
+    # Both are started inside the try, so the finally always stops them
+    metrics = PhaseMetrics(docs.get("traceMemory", False))
+    if docs.get("profile"):
+      import cProfile
+      profile_path = docs["profile"] if isinstance(docs["profile"], str) else output_path + ".pstats"
+      profiler = cProfile.Profile()
+      try:
+        profiler.enable()
+      except ValueError:
+        profiler = None  # Another profiler is already active in this process
+
+    # The previous run's manifest tells which sources are unchanged; only the
+    # changed ones need converting and counting
+    manifest = BuildManifest(output_path, draft, enabled=docs.get("incremental", True),
+                             compress=docs.get("compress", True), linearize=docs.get("linearize", False))
+    for doc_path in labels:
+      manifest.source_hash(doc_path)
+      if doc_path.endswith(".docx") and manifest.known_pages(doc_path) is None:
+        request_conversion(doc_path)
+
+    def source_pages(doc_path):
+      pages = manifest.known_pages(doc_path)
+      if pages is None:
+        pages = registry.page_count(source_pdf(doc_path))
+        manifest.set_pages(doc_path, pages)
+      metrics.conversion_pages(labels[doc_path], pages)
+      return pages
+
+    # Covers that can't come from the previous output are rendered into one
+    # document while conversions are still in flight, and sliced into place
+    covers = None
+    covers_path = os.path.join(temp_dir, "covers.pdf")
+
+    def render_cover(segment):
+      nonlocal covers
+      with metrics.phase("covers") as record:
+        if covers is None:
+          covers = CoverPages()
+        segment["first"], segment["pages"] = covers.add(*segment["cover"])
+        record["pages"] += segment["pages"]
+      segment["path"] = covers_path
+
+    # Plan the bundle as a list of segments; page numbers shown on covers and
+    # in the TOC assume a single TOC page
+    main_pages = source_pages(docs["main"])
+    segments = [{"kind": "main", "key": manifest.source_hash(docs["main"]), "source": docs["main"], "pages": main_pages}]
+    current_page = main_pages + 3
     if len(docs["attachments"]) > 0:
       toc = []
-      toc_path = os.path.join(temp_dir, "toc.pdf")
-      pdfs.append(toc_path)
-
-      appx_num = 0
-      #if fifo: os.write(fifo, bytes("מייצר דף מקדים לנספחים", 'utf-8'))
-      for attachment in docs["attachments"]:
-        pdf = FPDF(orientation="P", unit="mm", format="A4")
-        pdf.set_top_margin(40)
-        pdf.add_font('David', '', os.path.join(base_dir, "fonts", "David.ttf"), uni=True)
-        pdf.add_page()
-
-        appx_num += 1
-        appx_title = "נספח " + str(appx_num)
-        titles = [ rtl_line(appx_title), rtl_line(attachment["title"]), rtl_line("עמ' " + str(current_page)) ]
-
-        pdf.set_font("David", "U", size=36)
-        pdf.multi_cell(0, 14, txt=rtl_line(appx_title), border=0, align="C")
-        pdf.set_font("David", size=36)
-        pdf.cell(0, 15, txt="", ln=1, border=0, align="C")
-        pdf.multi_cell(0, 14, txt=rtl_line(attachment["title"]), border=0, align="C")
-        pdf.cell(0, 45, txt="", ln=1, border=0, align="C")
-        pdf.multi_cell(0, 14, txt=rtl_line("עמ' " + str(current_page)), border=0, align="C")
-
-        attachment_filename = os.path.splitext(attachment["path"])[0] + ".pdf"
-        attachment_filename = "_" + os.path.basename(attachment_filename)
-        appx_path = os.path.join(temp_dir, attachment_filename)
-        pdf.output(appx_path)
-        # pdf.close() - not needed in newer versions
-
-        pdfs.append(appx_path)
-        appx_path = attachment["path"]
-        if attachment["path"].endswith(".docx"):
-          current_step += 1
-          send_message("ממיר את נספח {} לקובץ PDF".format(appx_num), "converting", current_step)
-          appx_path = docx_convert(appx_path, temp_dir)
-        pdfs.append(appx_path)
-
-        toc.append([str(current_page), rtl_line(attachment["title"], 68), str(appx_num)])
-        with open(appx_path, "rb") as app_file:
-          read_pdf = PdfReader(app_file)
-          current_page = current_page + len(read_pdf.pages) + 1
-
-      #os.write(fifo, bytes("מייצר תוכן עיניינים לנספחים", 'utf-8'))
-      pdf = MyFPDF(orientation="P", unit="mm", format="A4")
-      pdf.set_top_margin(20)
-      pdf.set_left_margin(18)
-      pdf.add_font('David', '', os.path.join(base_dir, "fonts", "David.ttf"))
-      pdf.add_font('Davidbd', '', os.path.join(base_dir, "fonts", "davidbd.ttf"))
-      pdf.add_page()
-      pdf.set_font("Davidbd", "U", size=18)
-      pdf.cell(0, 10, txt="תוכן עניינים"[::-1], new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="C")
-      pdf.cell(0, 7, txt="", border=0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="C")
-      pdf.set_font("Davidbd", size=14)
-      headers = ["עמ'", "שם הנספח", "מס'"]
-      table_data = [[get_display(reshape(headers[0])), get_display(reshape(headers[1])), get_display(reshape(headers[2]))]]
-      with pdf.table(table_data, first_row_as_headings=False, col_widths=(7, 86, 7), text_align="CENTER") as table:
-        pass
-      pdf.set_font("David", size=12)
-      with pdf.table(toc, first_row_as_headings=False, line_height=pdf.font_size, col_widths=(7, 86, 7), text_align=("CENTER", "RIGHT", "CENTER"), padding=2) as table:
-        pass    
-      pdf.output(toc_path)
-  
-    current_step += 1
-    total_pdfs = len(pdfs)
-    for pdf_num in range(total_pdfs):
-      if (pdf_num%2==0):
-        send_message("מאחד קבצים למסמך אחד - {}/{}".format(pdf_num//2+1, total_pdfs//2), "merging", current_step)
-      merger.append(pdfs[pdf_num])
-    current_step += 1
-    send_message("שומר את המסמך המאוחד לקובץ", "merging", current_step)
+      toc_segment = {"kind": "toc"}
+      segments.append(toc_segment)
+      for appx_num, attachment in enumerate(docs["attachments"], 1):
+        cover = [appx_num, attachment["title"], current_page]
+        segment = {"kind": "cover", "key": json.dumps(cover, ensure_ascii=False), "cover": cover, "pages": 1}
+        if not manifest.known("cover", segment["key"]):
+          render_cover(segment)
+        segments.append(segment)
+        pages = source_pages(attachment["path"])
+        key = manifest.source_hash(attachment["path"])
+        if image_options:
+          key += "@{}dpi/q{}".format(*image_options)  # Optimized pages differ from the plain ones
+        segments.append({"kind": "attachment", "key": key, "source": attachment["path"], "pages": pages})
+        toc.append([current_page, attachment["title"], appx_num])
+        current_page = current_page + pages + 1
+      toc_segment["key"] = json.dumps(toc, ensure_ascii=False)
+      toc_segment["toc"] = toc
+
+    # A segment whose content and page offset are unchanged is copied from the
+    # previous output; everything else is rebuilt
+    offset = 0
+    for segment in segments:
+      segment["previous"] = manifest.reusable(segment["kind"], segment["key"], offset)
+      if segment["kind"] == "toc":
+        if segment["previous"]:
+          segment["pages"] = segment["previous"]["pages"]
+        else:
+          segment["path"] = os.path.join(temp_dir, "toc.pdf")
+          with metrics.phase("toc") as record:
+            toc_page(segment["path"], segment["toc"])
+            segment["pages"] = registry.page_count(segment["path"])
+            record["pages"] += segment["pages"]
+            record["bytes"] += os.path.getsize(segment["path"])
+      elif segment["kind"] == "cover" and not segment["previous"] and "path" not in segment:
+        render_cover(segment)
+      segment["offset"] = offset
+      manifest.add_segment(segment["kind"], segment["key"], offset, segment["pages"], segment["previous"] is not None)
+      offset += segment["pages"]
+    total_pages = offset
+
+    if manifest.unchanged():
+      docs["output"] = {"path": output_path, "updated": manifest.updated()}
+      result["output"] = docs["output"]
+      result["incremental"] = manifest.stats()
+      return result
+
+    if covers:
+      with metrics.phase("covers") as record:
+        covers.output(covers_path)
+        record["bytes"] += os.path.getsize(covers_path)
+    for segment in segments:
+      if not segment["previous"] and "source" in segment:
+        segment["path"] = source_pdf(segment["source"])
+    for doc_path in labels:
+      if doc_path.endswith(".docx") and doc_path not in converted_paths:
+        metrics.conversion(labels[doc_path], os.path.getsize(doc_path), "unchanged")
+        metrics.conversion_pages(labels[doc_path], manifest.known_pages(doc_path))
+        current_step += 1
+        send_message("{} לא השתנה מאז ההפקה הקודמת".format(labels[doc_path]), "converting", current_step, cache="unchanged")
 
-    output_path = docs["output"]["path"]
-    output_filename = os.path.basename(output_path)
-    merged_file = os.path.join(temp_dir, output_filename)
-    merger.write(merged_file)
+    # Oversized scans in changed attachments are downsampled on a process
+    # pool, one attachment per task; an attachment with nothing to gain keeps
+    # its original file
+    if image_options:
+      from image_optimizer import optimize_images
+      image_sources = {}
+      for segment in segments:
+        if segment["kind"] == "attachment" and not segment["previous"]:
+          image_sources.setdefault(segment["path"], []).append(segment)
+      current_step += 1
+      image_stats = {}
+      if image_sources:
+        workers = max(1, min(os.cpu_count() or 1, len(image_sources)))
+        with metrics.phase("optimizing") as record, ProcessPoolExecutor(max_workers=workers) as image_executor:
+          futures = {}
+          for num, path in enumerate(image_sources):
+            optimized_path = os.path.join(temp_dir, "images{}.pdf".format(num))
+            futures[image_executor.submit(optimize_images, path, optimized_path, *image_options)] = path
+          for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            send_message("מקטין תמונות בנספחים - {}/{}".format(done, len(futures)), "optimizing", current_step)
+            try:
+              stats = future.result()
+            except Exception as ex:
+              stats = {"error": str(ex)}  # The attachment is merged as it is
+            if stats.get("path"):
+              for segment in image_sources[path]:
+                segment["path"] = stats["path"]
+            stats.pop("path", None)
+            record["pages"] += sum(segment["pages"] for segment in image_sources[path])
+            record["bytes"] += os.path.getsize(path)
+            image_stats[path] = stats
+      attachments = []
+      for path, segments_of_path in image_sources.items():
+        attachments.append(dict(image_stats[path], attachment=labels[segments_of_path[0]["source"]]))
+      result["images"] = {
+        "dpi": image_options[0], "quality": image_options[1], "attachments": attachments,
+        "bytesSaved": sum(stats.get("bytesSaved", 0) for stats in attachments),
+      }
 
-    infile = PdfReader(merged_file)
-    outfile = PdfWriter()
-    total_pages = len(infile.pages)
-    draft = "isDraft" in docs and docs["isDraft"]==True
+    # Pages are pulled from each source, numbered and written straight to the
+    # output in a single pass - no intermediate merged file is written or re-read.
+    # In streaming mode pages go to the file as soon as they are numbered and
+    # each source is closed after its last segment, so memory stays bounded
+    # by the largest source instead of the whole bundle
+    from page_stamp import PageStamper
+    streaming = docs.get("streaming", False)
+    compress = docs.get("compress", True)
+    if streaming:
+      from bundle_writer import BundleWriter
+      output_fp = open(temp_output, "wb")
+      outfile = BundleWriter(output_fp, compress)
+    else:
+      from PyPDF2 import PdfWriter
+      outfile = PdfWriter()
+    stamper = PageStamper(outfile, os.path.join(base_dir, "assets", "draft.png") if draft else None)
+
+    last_use = {}
+    for segment_num, segment in enumerate(segments):
+      last_use[output_path if segment["previous"] else segment["path"]] = segment_num
 
     current_step += 1
-    for page_num in range(total_pages):
-      send_message("ממספר את העמודים במסמך - {}/{}".format(page_num+1, total_pages), "numbering", current_step)
-      page = infile.pages[page_num]
-      page.merge_page(page_number(page_num+1, draft))
-      outfile.add_page(page)
+    total_segments = len(segments)
+    written_pages = 0
+    merged_paths = set()
+    for segment_num, segment in enumerate(segments):
+      if (segment_num%2==0):
+        send_message("מאחד קבצים למסמך אחד - {}/{}".format(segment_num//2+1, total_segments//2), "merging", current_step)
+      previous = segment["previous"]
+      if previous:
+        path, first, stamp = output_path, previous["offset"], False
+      else:
+        path, first, stamp = segment["path"], segment.get("first", 0), True
+      with metrics.phase("merging") as record:
+        reader = registry.open(path)
+        pages = (first, first + segment["pages"])
+        if streaming:
+          new_pages = outfile.add_pages(reader, pages)
+          outfile.import_outline(reader, pages)
+          page_objects = [page for _, page in new_pages]
+        else:
+          outfile.append(reader, pages=pages)
+          page_objects = outfile.pages[written_pages:]
+        record["pages"] += segment["pages"]
+        if path not in merged_paths:
+          merged_paths.add(path)
+          record["bytes"] += os.path.getsize(path)
+      if stamp:
+        with metrics.phase("numbering") as record:
+          for page_num, page in enumerate(page_objects, written_pages):
+            send_message("ממספר את העמודים במסמך - {}/{}".format(page_num+1, total_pages), "numbering", current_step)
+            stamper.stamp(page, page_num+1)
+          record["pages"] += segment["pages"]
+      written_pages += segment["pages"]
+      if streaming:
+        with metrics.phase("saving"):
+          outfile.flush_pages(new_pages)
+          if last_use[path] == segment_num:
+            outfile.forget(reader)
+            registry.release(path)
     current_step += 1
     send_message("מפיק את הקובץ הסופי של המסמך המעובד", "saving", current_step)
-    with open(output_path, "wb") as fp:
-      outfile.write(fp)
-      updated_date = datetime.datetime.now().strftime("%Y-%m-%d")
-      docs["output"] = {"path": output_path, "updated": updated_date}
-      result["output"] = docs["output"]
+    # Written next to the output and swapped in, since unchanged pages are
+    # read from the previous output while writing
+    # Either way the file is written by BundleWriter, which keeps only what
+    # the pages (and outline) reference and shares identical streams
+    with metrics.phase("saving") as record:
+      if streaming:
+        outfile.close()
+        output_fp.close()
+        result["writer"] = outfile.stats()
+      else:
+        from bundle_writer import BundleWriter
+        with open(temp_output, "wb") as fp:
+          bundle = BundleWriter(fp, compress)
+          bundle.append(outfile, (0, len(outfile.pages)))
+          bundle.close(outfile._root_object)
+        result["writer"] = bundle.stats()
+      registry.close()
+      if docs.get("linearize", False):
+        # Reordered so page 1 and its resources are at the front of the file
+        from linearize import linearize
+        linearize(temp_output, linear_output)
+        os.replace(linear_output, output_path)
+      else:
+        os.replace(temp_output, output_path)
+      record["pages"] = total_pages
+      record["bytes"] = os.path.getsize(output_path)
+    updated_date = datetime.datetime.now().strftime("%Y-%m-%d")
+    manifest.save(updated_date)
+    docs["output"] = {"path": output_path, "updated": updated_date}
+    result["output"] = docs["output"]
+    result["documents"] = registry.stats()
+    result["incremental"] = manifest.stats()
+    if cache:
+      result["docxCache"] = cache.stats()
+    rtl_end = rtl_cache_info()
+    result["rtlCache"] = {key: rtl_end[key] - rtl_start[key] for key in rtl_end}
   except PermissionError:
     result = {"status": "error", "msg": "לא ניתן לייצר את הקובץ, ייתכן שכבר פתוח או שאין הרשאת כתיבה לתיקייה"}
   except Exception as ex:
-    result = {"status": "error", "msg": ex}
+    result = {"status": "error", "msg": str(ex)}
   finally:
-    merger.close()
+    if progress:
+      progress.close()
+    if output_fp:
+      output_fp.close()
+    registry.close()
+    if executor:
+      executor.shutdown(wait=True, cancel_futures=True)
+    if cache:
+      try:
+        cache.trim()
+        cache.save()
+      except OSError:
+        pass  # A cache that can't be updated must not fail the generation
+    for path in (temp_output, linear_output):
+      if os.path.exists(path):
+        try:
+          os.remove(path)
+        except OSError:
+          pass
 
-  #current_step += 1
-  #send_message("מוחק קבצים זמניים", "saving", current_step)
-  try:
-    shutil.rmtree(temp_dir)
-  except:
-    pass  # If there's an issue deleting temp folder, don't crash the program
+    #current_step += 1
+    #send_message("מוחק קבצים זמניים", "saving", current_step)
+    try:
+      shutil.rmtree(temp_dir)
+    except:
+      pass  # If there's an issue deleting temp folder, don't crash the program
+    if profiler:
+      profiler.disable()
+      try:
+        profiler.dump_stats(profile_path)
+        result["profile"] = profile_path
+      except OSError:
+        pass  # The run's result matters more than its profile
+    if metrics:
+      metrics.close()
+      result["metrics"] = metrics.report()
   return result;
 
+def profile_startup():
+  """Report the import cost of PdfGen itself and of every lazily loaded dependency (ms)
+
+  Each module's figure includes any of its own dependencies not loaded before it.
+  """
+  report = {"module": round((_module_ready - _module_start) * 1000, 2), "imports": {}}
+  for name in LAZY_MODULES:
+    start = time.perf_counter()
+    try:
+      importlib.import_module(name)
+      report["imports"][name] = round((time.perf_counter() - start) * 1000, 2)
+    except ImportError as ex:
+      report["imports"][name] = {"error": str(ex)}
+  report["total"] = round(report["module"] + sum(cost for cost in report["imports"].values() if isinstance(cost, float)), 2)
+  return report
+
+def worker(stdin, stdout):
+  """Resident mode: run newline-delimited JSON jobs and stream progress and results per job id
+
+  Each input line is {"id": ..., "docs": {...}}; {"type": "exit"} stops the worker.
+  Output lines are {"id": ..., "type": "status", ...} and {"id": ..., "type": "result", "result": {...}}.
+  """
+  lock = threading.Lock()
+
+  def emit(message):
+    with lock:
+      stdout.write(json.dumps(message) + "\n")
+      stdout.flush()
+
+  for line in stdin:
+    if not line.strip():
+      continue
+    try:
+      job = json.loads(line)
+    except ValueError:
+      emit({"id": None, "type": "result", "result": {"status": "error", "msg": "תקלה בפרמטרים"}})
+      continue
+    if job.get("type") == "exit":
+      break
+    job_id = job.get("id")
+    try:
+      result = generate(lambda status: emit(dict(status, id=job_id, type="status")), job.get("docs", {}))
+    except Exception:
+      result = {"status": "error", "msg": "תקלה בפרמטרים"}
+    emit({"id": job_id, "type": "result", "result": result})
+
+_module_ready = time.perf_counter()
+
 if __name__ == "__main__":
+  multiprocessing.freeze_support()  # Conversion workers re-launch the frozen executable
   sys.stdout.reconfigure(encoding='utf-8')  # Ensure UTF-8 output
   result = {"status": "error", "msg": "תקלה בפרמטרים"}
-  try:
-    if getattr(sys, 'frozen', False):
-      base_dir = os.path.dirname(sys.executable)
-      internal_dir = os.path.join(base_dir, "_internal")
-      if os.path.exists(internal_dir):
-        base_dir = internal_dir
-    else:
-      base_dir = os.path.dirname(os.path.abspath(__file__))
+  fifo = None
+  if getattr(sys, 'frozen', False):
+    base_dir = os.path.dirname(sys.executable)
+    internal_dir = os.path.join(base_dir, "_internal")
+    if os.path.exists(internal_dir):
+      base_dir = internal_dir
+  else:
+    base_dir = os.path.dirname(os.path.abspath(__file__))
 
+  if len(sys.argv) > 1 and sys.argv[1] == "--profile-startup":
+    print(json.dumps(profile_startup()))
+    sys.exit(0)
+
+  if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+    sys.stdin.reconfigure(encoding='utf-8')
+    worker(sys.stdin, sys.stdout)
+    sys.exit(0)
+
+  if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+    from batch import main as batch_main
+    sys.exit(batch_main(sys.argv[2:], generate, docx_convert, base_dir))
+
+  try:
     fifo = os.open(PIPE_PATH, os.O_WRONLY)
     #fifo=None
     docs = json.loads(sys.argv[1])
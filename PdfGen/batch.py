@@ -0,0 +1,241 @@
+# coding: utf8
+"""Batch mode: regenerate many cases in one run.
+
+Cases come from manifests - generate() inputs as JSON files, one object or
+a list of them - or straight from the app's db.json. Word files that
+changed since a case was last generated are converted first, once per
+distinct content, into the shared conversion cache; the cases are then
+run through generate() on a process pool sized to the machine, largest
+first. Pool processes are reused between cases, so each one parses the
+cover fonts once and keeps its display caches warm.
+
+  PdfGen --batch [manifest.json ...] [--db [db.json]] [--output-dir DIR] [--draft]
+                 [--workers N] [--convert-workers N] [--options JSON] [--report report.json]
+
+A JSON summary (per case status, output, timings) goes to --report or
+stdout; the exit code is 1 if any case failed.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import datetime
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+CONVERT_WORKERS = 4  # Word conversions at once, as in a single generate()
+
+def default_db_path():
+  """db.json written by the app (APPDATA on Windows, XDG config elsewhere)"""
+  root = os.environ.get("APPDATA") or os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+  return os.path.join(root, "din.docs", "db.json")
+
+def _file_path(entry):
+  """db.json keeps files as {"name", "path"} (older databases: a plain path)"""
+  return entry.get("path", "") if isinstance(entry, dict) else entry or ""
+
+def db_cases(db):
+  """Batch cases for every case of a db.json, in the order of its case list"""
+  titles = {item.get("id"): item.get("title", "") for item in db.get("cases", [])}
+  order = {case_id: num for num, case_id in enumerate(titles)}
+  cases = []
+  for item in sorted(db.get("case", []), key=lambda item: order.get(item.get("id"), len(order))):
+    files = item.get("files") or {}
+    docs = {
+      "main": _file_path(files.get("main")),
+      "attachments": [{"path": _file_path(attachment), "title": attachment.get("title") or attachment.get("name", "")}
+                      for attachment in files.get("attachments", []) if isinstance(attachment, dict)],
+      "output": {"path": item.get("path") or ""},
+    }
+    cases.append({"id": item.get("id"), "title": titles.get(item.get("id"), item.get("title", "")), "docs": docs})
+  return cases
+
+def load_cases(path):
+  """Batch cases from a db.json or a manifest of generate() inputs"""
+  with open(path, "r", encoding="utf-8") as fp:
+    data = json.load(fp)
+  if isinstance(data, dict) and "case" in data:
+    return db_cases(data)
+  stem = os.path.splitext(os.path.basename(path))[0]
+  manifests = data if isinstance(data, list) else [data]
+  cases = []
+  for num, docs in enumerate(manifests, 1):
+    case_id = docs.get("id") or (stem if len(manifests) == 1 else "{}#{}".format(stem, num))
+    cases.append({"id": case_id, "title": docs.get("title", ""), "docs": docs})
+  return cases
+
+def _sources(docs):
+  return [docs.get("main") or ""] + [attachment.get("path") or "" for attachment in docs.get("attachments", [])]
+
+def _case_size(case):
+  """Bytes of a case's sources, to start the biggest cases first"""
+  size = 0
+  for path in _sources(case["docs"]):
+    try:
+      size += os.path.getsize(path)
+    except OSError:
+      pass
+  return size
+
+def prepare(cases, output_dir, options):
+  """Fill in batch options; cases that can't run are marked skipped with the reason"""
+  outputs = {}
+  for case in cases:
+    docs = case["docs"] = dict(case["docs"], **options)
+    if output_dir:
+      docs["output"] = {"path": os.path.join(output_dir, "{}.pdf".format(case["id"]))}
+    output_path = (docs.get("output") or {}).get("path")
+    if not docs.get("main"):
+      case["skipped"] = "לתיק אין מסמך ראשי"
+    elif not output_path:
+      case["skipped"] = "לתיק אין קובץ פלט"
+    else:
+      key = os.path.normcase(os.path.abspath(output_path))
+      if key in outputs:
+        case["skipped"] = "קובץ הפלט משותף לתיק {}".format(outputs[key])
+      outputs.setdefault(key, case["id"])
+
+def preconvert(cases, convert, workers=CONVERT_WORKERS):
+  """Convert the Word files that changed, once per distinct content, into the conversion cache"""
+  from docx_cache import DocxCache
+  from build_manifest import BuildManifest
+  stats = {"converted": 0, "cached": 0, "unchanged": 0, "failed": []}
+  try:
+    cache = DocxCache()
+  except OSError:
+    return stats  # No usable cache, every case converts its own files
+
+  changed = {}  # Content hash -> a path with that content
+  for case in cases:
+    docs = case["docs"]
+    if case.get("skipped") or docs.get("docxCache", True) is False:
+      continue
+    manifest = BuildManifest(docs["output"]["path"], docs.get("isDraft") == True, enabled=docs.get("incremental", True),
+                             compress=docs.get("compress", True), linearize=docs.get("linearize", False))
+    for doc_path in _sources(docs):
+      if not doc_path.endswith(".docx") or not os.path.exists(doc_path):
+        continue
+      manifest.source_hash(doc_path)
+      if manifest.known_pages(doc_path) is not None:
+        stats["unchanged"] += 1
+        continue
+      digest, cached_path = cache.lookup(doc_path)
+      if cached_path:
+        stats["cached"] += 1
+      else:
+        changed.setdefault(digest, doc_path)
+
+  if changed:
+    temp_dir = tempfile.mkdtemp(prefix="dindocs_batch_")
+    try:
+      with ProcessPoolExecutor(max_workers=max(1, min(workers, len(changed)))) as executor:
+        futures = {}
+        for num, (digest, doc_path) in enumerate(changed.items()):
+          pdf_dir = os.path.join(temp_dir, "docx{}".format(num))
+          os.mkdir(pdf_dir)
+          futures[executor.submit(convert, doc_path, pdf_dir)] = digest, doc_path
+        for future in as_completed(futures):
+          digest, doc_path = futures[future]
+          try:
+            pdf_path, _, _ = future.result()
+            cache.store(digest, pdf_path)
+            stats["converted"] += 1
+          except Exception as ex:
+            stats["failed"].append({"path": doc_path, "msg": str(ex)})  # The case reports it again
+    finally:
+      shutil.rmtree(temp_dir, ignore_errors=True)
+  try:
+    cache.trim()
+    cache.save()
+  except OSError:
+    pass
+  return stats
+
+def _init_worker(generate, base_dir):
+  # generate() finds its fonts and assets through its module's base_dir, which
+  # is only set when that module runs as the main script. Set through its
+  # globals: a spawned worker runs the script in a namespace of its own
+  generate.__globals__["base_dir"] = base_dir
+
+def _run_case(generate, docs):
+  start = time.perf_counter()
+  try:
+    result = generate(None, docs)
+  except Exception as ex:
+    result = {"status": "error", "msg": str(ex)}
+  result["seconds"] = round(time.perf_counter() - start, 4)
+  return result
+
+def run_batch(cases, generate, convert, base_dir, workers=None, convert_workers=CONVERT_WORKERS, log=None):
+  """Run every case through generate(); returns the summary report
+
+  generate and convert are PdfGen's generate() and docx_convert(), passed in
+  so pool processes resolve them in the running PdfGen (a frozen build can't
+  import it by name).
+  """
+  started = datetime.datetime.now()
+  start = time.perf_counter()
+  workers = workers or os.cpu_count() or 1
+  report = {"started": started.strftime("%Y-%m-%dT%H:%M:%S"), "workers": workers}
+  report["conversions"] = preconvert(cases, convert, convert_workers)
+
+  runnable = sorted((case for case in cases if not case.get("skipped")), key=_case_size, reverse=True)
+  if runnable:
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(runnable))), initializer=_init_worker, initargs=(generate, base_dir)) as executor:
+      futures = {executor.submit(_run_case, generate, case["docs"]): case for case in runnable}
+      for done, future in enumerate(as_completed(futures), 1):
+        case = futures[future]
+        try:
+          case["result"] = future.result()
+        except Exception as ex:  # The worker process died
+          case["result"] = {"status": "error", "msg": str(ex)}
+        if log:
+          log("{}/{} {}: {}".format(done, len(runnable), case["id"], case["result"]["status"]))
+
+  report["cases"] = []
+  for case in cases:
+    entry = {"id": case["id"], "title": case["title"], "output": (case["docs"].get("output") or {}).get("path")}
+    if case.get("skipped"):
+      entry.update(status="skipped", msg=case["skipped"])
+    else:
+      entry.update(status=case["result"]["status"], result=case["result"])
+    report["cases"].append(entry)
+  statuses = [entry["status"] for entry in report["cases"]]
+  report["summary"] = {status: statuses.count(status) for status in ("success", "error", "skipped")}
+  report["seconds"] = round(time.perf_counter() - start, 4)
+  return report
+
+def main(argv, generate, convert, base_dir):
+  parser = argparse.ArgumentParser(prog="PdfGen --batch", description="regenerate many cases on a process pool")
+  parser.add_argument("manifests", nargs="*", help="generate() inputs as JSON (an object or a list), or db.json files")
+  parser.add_argument("--db", nargs="?", const=default_db_path(), help="read every case of the app's db.json (default: %(const)s)")
+  parser.add_argument("--output-dir", help="write each case to DIR/<case id>.pdf instead of its own output path")
+  parser.add_argument("--draft", action="store_true", help="mark every output as a draft")
+  parser.add_argument("--workers", type=int, help="cases run at once (default: one per CPU)")
+  parser.add_argument("--convert-workers", type=int, default=CONVERT_WORKERS, help="Word conversions run at once")
+  parser.add_argument("--options", default="{}", help="extra generate() options for every case as JSON")
+  parser.add_argument("--report", help="write the JSON report to this file instead of stdout")
+  args = parser.parse_args(argv)
+  if not args.manifests and not args.db:
+    parser.error("no cases: give manifests and/or --db")
+
+  cases = []
+  for path in args.manifests + ([args.db] if args.db else []):
+    cases.extend(load_cases(path))
+  options = json.loads(args.options)
+  if args.draft:
+    options["isDraft"] = True
+  if args.output_dir:
+    os.makedirs(args.output_dir, exist_ok=True)
+  prepare(cases, args.output_dir, options)
+
+  report = run_batch(cases, generate, convert, base_dir, args.workers, args.convert_workers, log=lambda line: print(line, file=sys.stderr))
+  text = json.dumps(report, ensure_ascii=False, indent=2)
+  if args.report:
+    with open(args.report, "w", encoding="utf-8") as fp:
+      fp.write(text)
+  else:
+    print(text)
+  return 0 if report["summary"]["error"] == 0 else 1
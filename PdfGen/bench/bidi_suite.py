@@ -0,0 +1,315 @@
+# coding: utf8
+"""BiDi conformance and throughput suite for bidi_display.
+
+Runs the Unicode BidiTest.txt / BidiCharacterTest.txt conformance files
+against get_display and benchmarks throughput on Hebrew legal text, mixed
+Hebrew/English/number strings and long paragraphs, next to python-bidi when
+it is installed. Results are printed (or written) as JSON so runs can be
+compared over time.
+
+The conformance files of UNICODE_VERSION belong in PdfGen/bench/unicode,
+next to a SHA256SUMS file pinning their content; --fetch downloads them from
+unicode.org (or pass --data-dir), pinning them on the first download and
+failing on a mismatch after that. A file whose checksum doesn't match is
+not run. The report gives each file's Unicode version, from its header, and
+counts the cases with isolates (LRI, RLI, FSI, PDI) separately as well.
+
+  python bench/bidi_suite.py [--fetch] [--output results.json] [--data-dir DIR] [--repeat N] [--quick]
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bidi_display
+from bidi_display import get_display, get_display_many, get_bidi_type
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "unicode")
+UNICODE_VERSION = "14.0.0"  # The character database of the Python PdfGen is built with (3.11)
+UCD_URL = "https://www.unicode.org/Public/{}/ucd/{}"
+CONFORMANCE_FILES = ("BidiTest.txt", "BidiCharacterTest.txt")
+CHECKSUM_FILE = "SHA256SUMS"  # "<sha256>  <versioned name, e.g. BidiTest-14.0.0.txt>" per line
+MAX_FAILURES = 20  # Failing cases kept per file in the report
+
+# Classes removed by rule X9; they have no level and no place in the visual order
+REMOVED_TYPES = {"LRE", "RLE", "LRO", "RLO", "PDF", "BN"}
+ISOLATE_TYPES = {"LRI", "RLI", "FSI", "PDI"}
+ISOLATE_CHARS = {"\u2066", "\u2067", "\u2068", "\u2069"}
+
+# A character of each class, used to turn BidiTest.txt class sequences into text
+CLASS_SAMPLES = {
+  "L": "a", "R": "\u05D0", "AL": "\u0627", "EN": "1", "ES": "+", "ET": "$", "AN": "\u0660",
+  "CS": ",", "NSM": "\u0300", "BN": "\u200B", "B": "\u2029", "S": "\t", "WS": " ", "ON": "!",
+  "LRE": "\u202A", "RLE": "\u202B", "PDF": "\u202C", "LRO": "\u202D", "RLO": "\u202E",
+  "LRI": "\u2066", "RLI": "\u2067", "FSI": "\u2068", "PDI": "\u2069",
+}
+AUTO_PARAGRAPH = 1  # BidiTest.txt paragraph bitset value for auto-LTR
+
+HEBREW_PHRASES = [
+  "בית המשפט המחוזי בתל אביב", "כתב תביעה", "כתב הגנה", "תצהיר עדות ראשית", "הודעה על הגשת מסמכים",
+  "בקשה למתן צו מניעה זמני", "התובע", "הנתבע", "המשיבה", "ב\"כ המבקש", "לפי סעיף", "לחוק החוזים",
+  "פסק דין", "החלטה", "פרוטוקול הדיון", "נספח", "עמוד", "הסכם שכירות", "ייפוי כוח", "חוות דעת מומחה",
+  "על פי האמור לעיל", "אשר על כן", "מתבקש בית המשפט הנכבד", "לחייב את הנתבעים", "בהוצאות משפט",
+]
+ENGLISH_WORDS = ["John Smith", "Ltd.", "Inc.", "Case", "Exhibit", "PDF", "Tel Aviv", "v.", "Re:", "Appendix"]
+NUMBER_TOKENS = ["12345-06-21", "1,250,000", "15.3.2021", "3", "(4)", "סעיף 12(ב)", "ת\"א 4567/19", "50%", "$200"]
+
+def _corpora(rng, quick):
+  """Named lists of benchmark strings"""
+  count = 200 if quick else 2000
+  hebrew = [" ".join(rng.choice(HEBREW_PHRASES) for _ in range(rng.randint(2, 6))) for _ in range(count)]
+  mixed = []
+  for _ in range(count):
+    words = [rng.choice(HEBREW_PHRASES + ENGLISH_WORDS + NUMBER_TOKENS) for _ in range(rng.randint(3, 8))]
+    mixed.append(" ".join(words))
+  paragraphs = [" ".join(rng.choice(HEBREW_PHRASES + ENGLISH_WORDS + NUMBER_TOKENS) for _ in range(1500 if quick else 4000))
+                for _ in range(3)]
+  return {"hebrew_legal": hebrew, "mixed": mixed, "paragraphs": paragraphs}
+
+def _baselines():
+  """Importable python-bidi implementations, by name"""
+  baselines = {}
+  try:
+    from bidi.algorithm import get_display as python_bidi
+    baselines["python-bidi"] = python_bidi
+  except ImportError:
+    pass
+  try:
+    from bidi import get_display as native_bidi  # Rust implementation in python-bidi >= 0.5
+    baselines["python-bidi-native"] = native_bidi
+  except ImportError:
+    pass
+  return baselines
+
+def _time(function, texts, repeat):
+  """Best of repeat runs of function over texts"""
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    function(texts)
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+def benchmark(repeat, quick, seed=1):
+  rng = random.Random(seed)
+  baselines = _baselines()
+  results = {}
+  for name, texts in _corpora(rng, quick).items():
+    chars = sum(len(text) for text in texts)
+    runs = {
+      "bidi_display": lambda texts: [get_display(text) for text in texts],
+      "bidi_display_many": lambda texts: list(get_display_many(texts)),
+    }
+    for baseline, function in baselines.items():
+      runs[baseline] = lambda texts, function=function: [function(text) for text in texts]
+    corpus = {"strings": len(texts), "chars": chars}
+    for run, function in runs.items():
+      seconds = _time(function, texts, repeat)
+      corpus[run] = {"seconds": round(seconds, 6), "charsPerSec": round(chars / seconds) if seconds else None}
+    if baselines:
+      reference = next(iter(baselines.values()))
+      same = sum(get_display(text) == reference(text) for text in texts)
+      corpus["agreement"] = {"baseline": next(iter(baselines)), "identical": same, "of": len(texts)}
+    results[name] = corpus
+  return results
+
+def _visual_types(text):
+  """Classes of the displayed characters, dropping those removed by X9"""
+  types = [get_bidi_type(char) for char in text]
+  return [bidi_type for bidi_type in types if bidi_type not in REMOVED_TYPES]
+
+class _Tally:
+  """Pass/fail counts of a conformance file, with isolate cases also counted on their own"""
+
+  def __init__(self):
+    self.passed = self.failed = self.skipped = 0
+    self.isolates = {"passed": 0, "failed": 0}
+    self.failures = []
+
+  def add(self, ok, isolate, failure):
+    if ok:
+      self.passed += 1
+    else:
+      self.failed += 1
+      if len(self.failures) < MAX_FAILURES:
+        self.failures.append(failure())
+    if isolate:
+      self.isolates["passed" if ok else "failed"] += 1
+
+  def report(self):
+    return {"passed": self.passed, "failed": self.failed, "skipped": self.skipped,
+            "isolates": self.isolates, "failures": self.failures}
+
+def run_bidi_test(path):
+  """BidiTest.txt: class sequences with expected levels and visual order.
+
+  Only the auto paragraph direction is checked, since get_display always
+  picks the base level from the first strong character.
+  """
+  tally = _Tally()
+  reorder = []
+  with open(path, "r", encoding="utf-8") as fp:
+    for line_num, line in enumerate(fp, 1):
+      line = line.split("#", 1)[0].strip()
+      if not line:
+        continue
+      if line.startswith("@Reorder:"):
+        reorder = [int(index) for index in line[len("@Reorder:"):].split()]
+        continue
+      if line.startswith("@"):
+        continue
+      classes, bitset = [field.strip() for field in line.split(";")]
+      if not int(bitset) & AUTO_PARAGRAPH:
+        tally.skipped += 1
+        continue
+      classes = classes.split()
+      text = "".join(CLASS_SAMPLES[bidi_class] for bidi_class in classes)
+      expected = [classes[index] for index in reorder]
+      actual = _visual_types(get_display(text))
+      tally.add(actual == expected, ISOLATE_TYPES.intersection(classes),
+                lambda: {"line": line_num, "classes": " ".join(classes), "expected": expected, "actual": actual})
+  return tally.report()
+
+def run_character_test(path):
+  """BidiCharacterTest.txt: code point sequences with expected visual order.
+
+  Cases with an explicit LTR/RTL paragraph direction are skipped. Expected
+  output mirrors characters at odd levels, as get_display does.
+  """
+  tally = _Tally()
+  with open(path, "r", encoding="utf-8") as fp:
+    for line_num, line in enumerate(fp, 1):
+      line = line.split("#", 1)[0].strip()
+      if not line:
+        continue
+      code_points, direction, _, levels, order = [field.strip() for field in line.split(";")]
+      if direction != "2":
+        tally.skipped += 1
+        continue
+      chars = [chr(int(code_point, 16)) for code_point in code_points.split()]
+      levels = levels.split()
+      expected = []
+      for index in (int(index) for index in order.split()):
+        char = chars[index]
+        if int(levels[index]) % 2:
+          char = bidi_display.MIRRORED_CHARS.get(char, char)
+        expected.append(char)
+      removed = {char for char, level in zip(chars, levels) if level == "x"}
+      actual = [char for char in get_display("".join(chars)) if char not in removed]
+      tally.add(actual == expected, ISOLATE_CHARS.intersection(chars),
+                lambda: {"line": line_num, "input": code_points,
+                         "expected": " ".join("%04X" % ord(char) for char in expected),
+                         "actual": " ".join("%04X" % ord(char) for char in actual)})
+  return tally.report()
+
+def _file_version(path):
+  """Unicode version from a UCD file's header line, e.g. "# BidiTest-14.0.0.txt" """
+  with open(path, "r", encoding="utf-8") as fp:
+    match = re.search(r"-(\d+\.\d+\.\d+)\.txt", fp.readline())
+  return match.group(1) if match else None
+
+def _versioned(name, version):
+  stem, ext = os.path.splitext(name)
+  return "{}-{}{}".format(stem, version, ext)
+
+def _sha256(path):
+  sha = hashlib.sha256()
+  with open(path, "rb") as fp:
+    for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+      sha.update(chunk)
+  return sha.hexdigest()
+
+def read_checksums(data_dir):
+  """Pinned SHA-256 of each conformance file, by versioned name"""
+  checksums = {}
+  try:
+    with open(os.path.join(data_dir, CHECKSUM_FILE), "r", encoding="utf-8") as fp:
+      for line in fp:
+        if line.strip():
+          digest, name = line.split()
+          checksums[name] = digest
+  except FileNotFoundError:
+    pass
+  return checksums
+
+def fetch(data_dir, version=UNICODE_VERSION):
+  """Download the conformance files of a Unicode version into data_dir.
+
+  Files already pinned in SHA256SUMS must match; the others are pinned
+  there. Raises ValueError on a mismatch, keeping the files in place.
+  """
+  from urllib.request import urlopen
+  os.makedirs(data_dir, exist_ok=True)
+  checksums = read_checksums(data_dir)
+  for name in CONFORMANCE_FILES:
+    path = os.path.join(data_dir, name)
+    with urlopen(UCD_URL.format(version, name)) as response, open(path + ".tmp", "wb") as fp:
+      shutil.copyfileobj(response, fp)
+    digest = _sha256(path + ".tmp")
+    pinned = checksums.setdefault(_versioned(name, version), digest)
+    if digest != pinned:
+      os.remove(path + ".tmp")
+      raise ValueError("{} of Unicode {} doesn't match its pinned SHA-256 {}".format(name, version, pinned))
+    os.replace(path + ".tmp", path)
+  with open(os.path.join(data_dir, CHECKSUM_FILE), "w", encoding="utf-8") as fp:
+    fp.writelines("{}  {}\n".format(digest, name) for name, digest in sorted(checksums.items()))
+
+def conformance(data_dir):
+  results = {}
+  checksums = read_checksums(data_dir)
+  for name, runner in zip(CONFORMANCE_FILES, (run_bidi_test, run_character_test)):
+    path = os.path.join(data_dir, name)
+    if not os.path.exists(path):
+      results[name] = {"missing": path}
+      continue
+    version, digest = _file_version(path), _sha256(path)
+    pinned = checksums.get(_versioned(name, version))
+    if pinned and digest != pinned:
+      results[name] = {"unicodeVersion": version, "sha256": digest, "checksumMismatch": pinned}
+      continue
+    start = time.perf_counter()
+    results[name] = runner(path)
+    results[name].update(unicodeVersion=version, sha256=digest, pinned=pinned is not None)
+    results[name]["seconds"] = round(time.perf_counter() - start, 3)
+  return results
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="bidi_display conformance and benchmark suite")
+  parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+  parser.add_argument("--data-dir", default=DATA_DIR, help="folder with BidiTest.txt and BidiCharacterTest.txt")
+  parser.add_argument("--fetch", action="store_true", help="download the Unicode {} conformance files into --data-dir first".format(UNICODE_VERSION))
+  parser.add_argument("--repeat", type=int, default=5, help="benchmark runs per measurement (best is kept)")
+  parser.add_argument("--quick", action="store_true", help="smaller corpora, for a fast check")
+  parser.add_argument("--skip-conformance", action="store_true")
+  parser.add_argument("--skip-benchmark", action="store_true")
+  args = parser.parse_args(argv)
+
+  results = {
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+  }
+  if args.fetch:
+    fetch(args.data_dir)
+  if not args.skip_conformance:
+    results["conformance"] = conformance(args.data_dir)
+  if not args.skip_benchmark:
+    results["benchmark"] = benchmark(args.repeat, args.quick)
+
+  text = json.dumps(results, ensure_ascii=False, indent=2)
+  if args.output:
+    with open(args.output, "w", encoding="utf-8") as fp:
+      fp.write(text)
+  else:
+    print(text)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,278 @@
+# coding: utf8
+"""End-to-end benchmark of generate() on synthetic cases.
+
+Builds cases locally - a main document and N attachments of M pages each,
+mixing text pages and image-heavy (scan-like) pages, with Hebrew titles -
+and runs generate() on each with the progress pipe disabled and draft on
+and/or off. Word attachments are served by a stand-in docx2pdf that copies
+a pre-rendered PDF, so no Word installation is needed.
+
+Wall time and peak RSS are recorded per phase (covers, toc, merge,
+numbering, save) by timing the pipeline functions that implement them;
+merging and numbering alternate per segment, so their times are totals.
+Results are printed (or written) as JSON, one entry per case size, so
+scaling from 10 to 5,000 pages can be compared between versions.
+
+  python bench/generate_bench.py [--case 5x2 --case 50x100 ...] [--draft on|off|both]
+                                 [--image-ratio 0.2] [--docx-ratio 0.5] [--repeat N] [--output results.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import functools
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PDFGEN_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, PDFGEN_DIR)
+from bidi_suite import HEBREW_PHRASES
+
+DEFAULT_CASES = ["1x10", "5x20", "20x50", "50x100"]  # attachments x pages: 10 to 5,000 attachment pages
+PHASES = ["covers", "toc", "merge", "numbering", "save"]
+SAMPLE_INTERVAL = 0.005  # Seconds between RSS samples
+
+DOCX2PDF_STAND_IN = '''import os
+import time
+import shutil
+
+def convert(doc_path, pdf_path):
+  """Benchmark stand-in: the .docx files are PDFs already"""
+  time.sleep(float(os.environ.get("DINDOCS_BENCH_CONVERT_DELAY", "0")))
+  shutil.copyfile(doc_path, pdf_path)
+'''
+
+def _rss():
+  """Resident set size of this process in bytes, None where it can't be read"""
+  try:
+    import psutil
+    return psutil.Process().memory_info().rss
+  except ImportError:
+    pass
+  try:
+    with open("/proc/self/statm") as fp:
+      return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, AttributeError):
+    return None
+
+class PhaseRecorder:
+  """Wall time and peak RSS per phase, from wrapped pipeline functions and a sampling thread"""
+
+  def __init__(self):
+    self.phase = None
+    self.seconds = dict.fromkeys(PHASES, 0.0)
+    self.peak = dict.fromkeys(PHASES)
+    self.total_peak = None
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.patches = []
+
+  def _sample(self):
+    rss = _rss()
+    if rss is None:
+      return
+    with self.lock:
+      self.total_peak = max(self.total_peak or 0, rss)
+      if self.phase:
+        self.peak[self.phase] = max(self.peak[self.phase] or 0, rss)
+
+  def _run(self):
+    while not self.stopped.wait(SAMPLE_INTERVAL):
+      self._sample()
+
+  def wrap(self, owner, name, phase):
+    function = getattr(owner, name)
+
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+      if self.phase:
+        return function(*args, **kwargs)  # Already inside a phase
+      self.phase = phase
+      self._sample()
+      start = time.perf_counter()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        self.seconds[phase] += time.perf_counter() - start
+        self._sample()
+        self.phase = None
+
+    setattr(owner, name, timed)
+    self.patches.append((owner, name, function))
+
+  def __enter__(self):
+    import PdfGen
+    import linearize
+    from PyPDF2 import PdfWriter
+    from page_stamp import PageStamper
+    from bundle_writer import BundleWriter
+    self.wrap(PdfGen.CoverPages, "add", "covers")
+    self.wrap(PdfGen.CoverPages, "output", "covers")
+    self.wrap(PdfGen, "toc_page", "toc")
+    self.wrap(PdfWriter, "append", "merge")
+    self.wrap(BundleWriter, "add_pages", "merge")
+    self.wrap(BundleWriter, "flush_pages", "merge")
+    self.wrap(PageStamper, "stamp", "numbering")
+    self.wrap(BundleWriter, "append", "save")  # Only used to serialize the PdfWriter
+    self.wrap(BundleWriter, "close", "save")
+    self.wrap(linearize, "linearize", "save")
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.stopped.set()
+    self.thread.join()
+    for owner, name, function in reversed(self.patches):
+      setattr(owner, name, function)
+
+  def report(self):
+    megabytes = lambda value: round(value / 2**20, 1) if value is not None else None
+    return {
+      "phases": {phase: {"seconds": round(self.seconds[phase], 4), "peakRssMB": megabytes(self.peak[phase])}
+                 for phase in PHASES},
+      "peakRssMB": megabytes(self.total_peak),
+    }
+
+def _text_page(pdf, label, rng):
+  pdf.add_page()
+  pdf.set_font("Helvetica", size=11)
+  for line_num in range(45):
+    words = " ".join(rng.choice(("lorem", "ipsum", "dolor", "sit", "amet", "section", "court", "exhibit")) for _ in range(12))
+    pdf.cell(0, 5.5, "{} {} {}".format(label, line_num, words), new_x="LMARGIN", new_y="NEXT")
+
+def _scan_image(folder):
+  """A page-sized noisy JPEG standing in for a 200 dpi scan"""
+  path = os.path.join(folder, "scan.jpg")
+  if not os.path.exists(path):
+    from PIL import Image
+    noise = Image.effect_noise((1654, 2339), 24).point(lambda value: min(255, value + 100))
+    noise.convert("RGB").save(path, quality=80)
+  return path
+
+def synthetic_document(path, pages, image_ratio, seed, folder):
+  """PDF of text pages and full-page scan images in the given ratio"""
+  from fpdf import FPDF
+  rng = random.Random(seed)
+  pdf = FPDF()
+  for page_num in range(pages):
+    if rng.random() < image_ratio:
+      pdf.add_page()
+      pdf.image(_scan_image(folder), x=0, y=0, w=pdf.w, h=pdf.h)
+    else:
+      _text_page(pdf, "doc {} page {}".format(seed, page_num + 1), rng)
+  pdf.output(path)
+
+def synthetic_case(folder, attachments, pages, image_ratio, docx_ratio, seed=1):
+  """docs for generate(): sources are rendered once per case size and reused"""
+  rng = random.Random(seed)
+  case_dir = os.path.join(folder, "case_{}x{}".format(attachments, pages))
+  os.makedirs(case_dir, exist_ok=True)
+
+  def source(name, num):
+    extension = ".docx" if rng.random() < docx_ratio else ".pdf"
+    path = os.path.join(case_dir, name + extension)
+    if not os.path.exists(path):
+      synthetic_document(path, pages, image_ratio, num, folder)
+    return path
+
+  docs = {"main": source("main", 0), "attachments": []}
+  for appx_num in range(1, attachments + 1):
+    title = " ".join(rng.choice(HEBREW_PHRASES) for _ in range(rng.randint(2, 4)))
+    docs["attachments"].append({"title": title, "path": source("attachment{}".format(appx_num), appx_num)})
+  return docs
+
+def _version():
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PDFGEN_DIR, capture_output=True,
+                          text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def run_case(docs, draft, output_path, options):
+  import PdfGen
+  docs = dict(docs, isDraft=draft, output={"path": output_path}, incremental=False, docxCache=False)
+  docs.update(options)
+  with PhaseRecorder() as recorder:
+    start = time.perf_counter()
+    result = PdfGen.generate(None, docs)
+    wall = time.perf_counter() - start
+  report = recorder.report()
+  report["seconds"] = round(wall, 4)
+  report["status"] = result["status"]
+  report["metrics"] = result.get("metrics")  # generate()'s own per-phase CPU time, pages and bytes
+  if result["status"] == "success":
+    report["outputBytes"] = os.path.getsize(output_path)
+  else:
+    report["error"] = result.get("msg")
+  return report
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="end-to-end generate() benchmark on synthetic cases")
+  parser.add_argument("--case", action="append", help="ATTACHMENTSxPAGES, e.g. 20x50 (repeatable)")
+  parser.add_argument("--draft", choices=("on", "off", "both"), default="both")
+  parser.add_argument("--image-ratio", type=float, default=0.2, help="share of scan-like image pages")
+  parser.add_argument("--docx-ratio", type=float, default=0.5, help="share of sources given as Word files")
+  parser.add_argument("--convert-delay", type=float, default=0.0, help="seconds each stand-in conversion takes")
+  parser.add_argument("--options", default="{}", help="extra generate() options as JSON, e.g. '{\"streaming\": true}'")
+  parser.add_argument("--repeat", type=int, default=1, help="runs per case (the fastest is kept)")
+  parser.add_argument("--work-dir", help="keep synthetic sources here between runs (default: a temp folder)")
+  parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+  args = parser.parse_args(argv)
+
+  folder = args.work_dir or tempfile.mkdtemp(prefix="dindocs_bench_")
+  os.makedirs(folder, exist_ok=True)
+  stand_in_dir = os.path.join(folder, "stand_in")
+  os.makedirs(stand_in_dir, exist_ok=True)
+  with open(os.path.join(stand_in_dir, "docx2pdf.py"), "w", encoding="utf-8") as fp:
+    fp.write(DOCX2PDF_STAND_IN)
+  # Conversion workers are separate processes, so they find the stand-in through PYTHONPATH
+  sys.path.insert(0, stand_in_dir)
+  os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [stand_in_dir, os.environ.get("PYTHONPATH")]))
+  os.environ["DINDOCS_BENCH_CONVERT_DELAY"] = str(args.convert_delay)
+
+  import PdfGen
+  PdfGen.base_dir = PDFGEN_DIR
+  options = json.loads(args.options)
+  drafts = {"on": [True], "off": [False], "both": [False, True]}[args.draft]
+
+  results = []
+  try:
+    for case in args.case or DEFAULT_CASES:
+      attachments, pages = (int(value) for value in case.lower().split("x"))
+      docs = synthetic_case(folder, attachments, pages, args.image_ratio, args.docx_ratio)
+      for draft in drafts:
+        runs = [run_case(docs, draft, os.path.join(folder, "output.pdf"), options) for _ in range(args.repeat)]
+        best = min(runs, key=lambda run: run["seconds"])
+        best.update({"case": case, "attachments": attachments, "pagesPerDocument": pages,
+                     "pages": (attachments + 1) * pages, "draft": draft})
+        results.append(best)
+        print("{} draft={}: {}s".format(case, draft, best["seconds"]), file=sys.stderr)
+  finally:
+    if not args.work_dir:
+      shutil.rmtree(folder, ignore_errors=True)
+
+  report = {
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "version": _version(),
+    "settings": {"imageRatio": args.image_ratio, "docxRatio": args.docx_ratio,
+                 "convertDelay": args.convert_delay, "options": options},
+    "results": results,
+  }
+  text = json.dumps(report, ensure_ascii=False, indent=2)
+  if args.output:
+    with open(args.output, "w", encoding="utf-8") as fp:
+      fp.write(text)
+  else:
+    print(text)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,125 @@
+# coding: utf8
+"""Output size and write time of the bundle writers.
+
+Builds a numbered bundle the way generate() does (sources appended to a
+PdfWriter and stamped) and times serializing it with PyPDF2's own writer
+(the output before BundleWriter), BundleWriter with a classic xref table,
+and BundleWriter with object streams, an xref stream and deflated content
+(the default). Results are printed (or written) as JSON.
+
+Sources are the PDF files given on the command line, or synthetic text
+documents generated with fpdf2.
+
+  python bench/output_bench.py [--files N] [--pages N] [--draft] [--repeat N] [--output results.json] [pdf ...]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from bundle_writer import BundleWriter
+from page_stamp import PageStamper
+
+LINE = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore {}"
+
+def synthetic_sources(folder, files, pages):
+  """files text PDFs of pages pages each, like Word output of a typical attachment"""
+  from fpdf import FPDF
+  paths = []
+  for file_num in range(files):
+    pdf = FPDF()
+    pdf.set_font("Helvetica", size=11)
+    for page_num in range(pages):
+      pdf.add_page()
+      for line_num in range(45):
+        pdf.cell(0, 5.5, LINE.format(file_num * 100000 + page_num * 100 + line_num), new_x="LMARGIN", new_y="NEXT")
+    path = os.path.join(folder, "source{}.pdf".format(file_num))
+    pdf.output(path)
+    paths.append(path)
+  return paths
+
+def build_bundle(paths, draft):
+  """PdfWriter with every source appended and numbered, as generate() builds it"""
+  from PyPDF2 import PdfReader, PdfWriter
+  writer = PdfWriter()
+  draft_path = os.path.join(os.path.dirname(BENCH_DIR), "assets", "draft.png") if draft else None
+  stamper = PageStamper(writer, draft_path)
+  for path in paths:
+    writer.append(PdfReader(path))
+  for page_num, page in enumerate(writer.pages, 1):
+    stamper.stamp(page, page_num)
+  return writer
+
+def write_pypdf2(writer, fp):
+  writer.write(fp)
+
+def write_bundle(compress):
+  def write(writer, fp):
+    bundle = BundleWriter(fp, compress)
+    bundle.append(writer, (0, len(writer.pages)))
+    bundle.close(writer._root_object)
+  return write
+
+WRITERS = {
+  "pypdf2": write_pypdf2,
+  "bundle_classic": write_bundle(False),
+  "bundle_compressed": write_bundle(True),
+}
+
+def benchmark(paths, draft, repeat, folder):
+  writer = build_bundle(paths, draft)
+  results = {"pages": len(writer.pages), "sourceBytes": sum(os.path.getsize(path) for path in paths)}
+  for name, write in WRITERS.items():
+    output_path = os.path.join(folder, name + ".pdf")
+    best = None
+    for _ in range(repeat):
+      start = time.perf_counter()
+      with open(output_path, "wb") as fp:
+        write(writer, fp)
+      elapsed = time.perf_counter() - start
+      best = elapsed if best is None else min(best, elapsed)
+    results[name] = {"seconds": round(best, 4), "bytes": os.path.getsize(output_path)}
+  base = results["pypdf2"]
+  for name in WRITERS:
+    results[name]["sizeRatio"] = round(results[name]["bytes"] / base["bytes"], 3)
+    results[name]["timeRatio"] = round(results[name]["seconds"] / base["seconds"], 3) if base["seconds"] else None
+  return results
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="bundle writer size and speed benchmark")
+  parser.add_argument("sources", nargs="*", help="PDF files to bundle (default: synthetic documents)")
+  parser.add_argument("--files", type=int, default=20, help="synthetic source documents")
+  parser.add_argument("--pages", type=int, default=50, help="pages per synthetic document")
+  parser.add_argument("--draft", action="store_true", help="stamp the draft watermark as well")
+  parser.add_argument("--repeat", type=int, default=3, help="runs per writer (best is kept)")
+  parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+  args = parser.parse_args(argv)
+
+  folder = tempfile.mkdtemp(prefix="dindocs_bench_")
+  try:
+    paths = args.sources or synthetic_sources(folder, args.files, args.pages)
+    results = {
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+      "draft": args.draft,
+      "results": benchmark(paths, args.draft, args.repeat, folder),
+    }
+  finally:
+    shutil.rmtree(folder, ignore_errors=True)
+
+  text = json.dumps(results, ensure_ascii=False, indent=2)
+  if args.output:
+    with open(args.output, "w", encoding="utf-8") as fp:
+      fp.write(text)
+  else:
+    print(text)
+
+if __name__ == "__main__":
+  main()
@@ -5,8 +5,12 @@ Based on Unicode Bidirectional Algorithm (UAX #9).
 Includes full mirroring support and all BiDi features.
 """
 
+import re
 import sys
+from array import array
+from bisect import bisect_right
 from collections import deque
+from itertools import islice
 from typing import Union
 
 # Unicode ranges for BiDi character classification
@@ -43,23 +47,12 @@ BIDI_RANGES = [
     (0x05D0, 0x05EA, 'R'),  # Hebrew letters
     (0x05F0, 0x05F2, 'R'),
     (0x05F3, 0x05F4, 'R'),
-    (0x0608, 0x0608, 'R'),
-    (0x060B, 0x060B, 'R'),
-    (0x060D, 0x060D, 'R'),
-    (0x061B, 0x061B, 'R'),
-    (0x061C, 0x061C, 'R'),
-    (0x061E, 0x064A, 'R'),
     
     # Strong AL (Arabic)
-    (0x0600, 0x0605, 'AL'),
-    (0x0606, 0x0608, 'AL'),
-    (0x0609, 0x060A, 'AL'),
-    (0x060C, 0x060C, 'AL'),
-    (0x060E, 0x061A, 'AL'),
-    (0x061D, 0x061D, 'AL'),
-    (0x061F, 0x061F, 'AL'),
-    (0x0620, 0x063F, 'AL'),
-    (0x0641, 0x064A, 'AL'),
+    (0x0608, 0x0608, 'AL'),
+    (0x060B, 0x060B, 'AL'),
+    (0x060D, 0x060D, 'AL'),
+    (0x061B, 0x064A, 'AL'),
     (0x066D, 0x066F, 'AL'),
     (0x0671, 0x06D3, 'AL'),
     (0x06D5, 0x06D5, 'AL'),
@@ -69,7 +62,6 @@ BIDI_RANGES = [
     (0x06FF, 0x06FF, 'AL'),
     (0x0750, 0x077F, 'AL'),
     (0x08A0, 0x08AC, 'AL'),
-    (0x08E3, 0x08FF, 'AL'),
     
     # European Numbers
     (0x0030, 0x0039, 'EN'),  # 0-9
@@ -77,6 +69,7 @@ BIDI_RANGES = [
     (0x00B9, 0x00B9, 'EN'),
     
     # Arabic Numbers  
+    (0x0600, 0x0605, 'AN'),  # Arabic number signs
     (0x0660, 0x0669, 'AN'),
     (0x066B, 0x066C, 'AN'),
     
@@ -88,24 +81,23 @@ BIDI_RANGES = [
     (0x0023, 0x0025, 'ET'),  # # $ %
     (0x00A2, 0x00A5, 'ET'),  # Currency symbols
     (0x00B0, 0x00B1, 'ET'),
+    (0x0609, 0x060A, 'ET'),  # Arabic per mille / per ten thousand
     
     # Common Separators
     (0x002C, 0x002C, 'CS'),  # ,
     (0x002E, 0x002F, 'CS'),  # . /
     (0x003A, 0x003A, 'CS'),  # :
     (0x00A0, 0x00A0, 'CS'),  # Non-breaking space
+    (0x060C, 0x060C, 'CS'),  # Arabic comma
     
     # Whitespace
-    (0x0009, 0x000D, 'WS'),  # Tab, LF, VT, FF, CR
+    (0x000C, 0x000C, 'WS'),  # Form Feed
     (0x0020, 0x0020, 'WS'),  # Space
-    (0x001C, 0x001F, 'WS'),  # File/Group/Record/Unit Separator
-    (0x0085, 0x0085, 'WS'),  # Next Line
-    (0x00A0, 0x00A0, 'WS'),  # Non-breaking space
     
     # Paragraph Separators
     (0x000A, 0x000A, 'B'),   # Line Feed
     (0x000D, 0x000D, 'B'),   # Carriage Return
-    (0x001C, 0x001F, 'B'),   # File/Group/Record/Unit Separator
+    (0x001C, 0x001E, 'B'),   # File/Group/Record Separator
     (0x0085, 0x0085, 'B'),   # Next Line
     (0x2029, 0x2029, 'B'),   # Paragraph Separator
     
@@ -120,6 +112,8 @@ BIDI_RANGES = [
     (0x003B, 0x0040, 'ON'),  # ; < = > ? @
     (0x005B, 0x0060, 'ON'),  # [ \ ] ^ _ `
     (0x007B, 0x007E, 'ON'),  # { | } ~
+    (0x0606, 0x0607, 'ON'),  # Arabic-Indic cube / fourth root
+    (0x060E, 0x060F, 'ON'),  # Arabic poetic verse / misra signs
     
     # Nonspacing Marks (simplified)
     (0x0300, 0x036F, 'NSM'), # Combining diacritics
@@ -136,6 +130,7 @@ BIDI_RANGES = [
     (0x06DF, 0x06E4, 'NSM'),
     (0x06E7, 0x06E8, 'NSM'),
     (0x06EA, 0x06ED, 'NSM'),
+    (0x08E3, 0x08FF, 'NSM'),
     
     # Boundary Neutral
     (0x0000, 0x0008, 'BN'),
@@ -352,28 +347,66 @@ MIRRORED_CHARS = {
     '｢': '｣', '｣': '｢',
 }
 
+# BiDi types by table index; index 0 (Other Neutral) is the default for
+# unclassified characters
+BIDI_TYPES = ('ON', 'L', 'R', 'AL', 'EN', 'AN', 'ES', 'ET', 'CS', 'WS', 'B', 'S', 'NSM', 'BN',
+              'LRE', 'RLE', 'LRO', 'RLO', 'PDF', 'LRI', 'RLI', 'FSI', 'PDI')
+BMP_LIMIT = 0x10000
+
+_TYPE_CODES = {bidi_type: code for code, bidi_type in enumerate(BIDI_TYPES)}
+(ON, L, R, AL, EN, AN, ES, ET, CS, WS, B, S, NSM, BN,
+ LRE, RLE, LRO, RLO, PDF, LRI, RLI, FSI, PDI) = range(len(BIDI_TYPES))
+# Type given to characters inside an LRO/RLO override; like the original
+# implementation it matches none of the weak or neutral rules
+OVERRIDDEN = len(BIDI_TYPES)
+
+def _build_tables():
+    """Expand BIDI_RANGES into a direct table for the BMP and sorted ranges above it."""
+    bmp = bytearray(BMP_LIMIT)
+    astral = []
+    for start, end, bidi_type in BIDI_RANGES:
+        if start < BMP_LIMIT:
+            last = min(end, BMP_LIMIT - 1)
+            bmp[start:last + 1] = bytes([_TYPE_CODES[bidi_type]]) * (last - start + 1)
+        if end >= BMP_LIMIT:
+            astral.append((max(start, BMP_LIMIT), end, bidi_type))
+    astral.sort()
+    return bmp, [start for start, _, _ in astral], astral
+
+_BMP_TYPES, _ASTRAL_STARTS, _ASTRAL_RANGES = _build_tables()
+
 def get_bidi_type(char):
     """Get the bidirectional type of a character."""
     code_point = ord(char)
+    if code_point < BMP_LIMIT:
+        return BIDI_TYPES[_BMP_TYPES[code_point]]
     
-    # Check ranges for character type
-    for start, end, bidi_type in BIDI_RANGES:
-        if start <= code_point <= end:
-            return bidi_type
+    i = bisect_right(_ASTRAL_STARTS, code_point) - 1
+    if i >= 0 and code_point <= _ASTRAL_RANGES[i][1]:
+        return _ASTRAL_RANGES[i][2]
     
     # Default to Other Neutral for unclassified characters
     return 'ON'
 
-def get_base_level(text):
-    """Get the paragraph base embedding level."""
-    for char in text:
-        bidi_type = get_bidi_type(char)
-        if bidi_type in ('R', 'AL'):
+def _type_codes(text):
+    """Type codes (indexes into BIDI_TYPES) of every character in text."""
+    if not text or max(text) < '\U00010000':
+        return bytearray(map(_BMP_TYPES.__getitem__, map(ord, text)))
+    return bytearray(_BMP_TYPES[code_point] if code_point < BMP_LIMIT else _TYPE_CODES[get_bidi_type(chr(code_point))]
+                     for code_point in map(ord, text))
+
+def _first_strong_level(types):
+    for code in types:
+        if code == R or code == AL:
             return 1
-        elif bidi_type == 'L':
+        elif code == L:
             return 0
     return 0
 
+def get_base_level(text):
+    """Get the paragraph base embedding level."""
+    return _first_strong_level(_type_codes(text))
+
 def get_display(text: Union[str, bytes], encoding: str = 'utf-8') -> Union[str, bytes]:
     """
     Apply Unicode Bidirectional Algorithm to text.
@@ -395,250 +428,324 @@ def get_display(text: Union[str, bytes], encoding: str = 'utf-8') -> Union[str,
     if not text_str:
         return text
     
-    # Step 1: Get base level and create character storage
-    base_level = get_base_level(text_str)
-    chars = []
+    result = _display(text_str, _type_codes(text_str))
+    
+    if return_bytes:
+        return result.encode(encoding)
+    return result
+
+BATCH_SIZE = 256  # Texts classified together by get_display_many
+
+def get_display_many(texts, encoding: str = 'utf-8'):
+    """
+    Apply get_display to a sequence of texts, yielding the results in order.
     
-    for char in text_str:
-        bidi_type = get_bidi_type(char)
-        chars.append({
-            'char': char,
-            'type': bidi_type,
-            'orig_type': bidi_type,
-            'level': base_level
-        })
+    Texts are classified in batches through one shared type buffer and
+    identical inputs are resolved once, so tables and lists of strings skip
+    most of the per-call setup. Being a generator, it can feed very long
+    lists (e.g. thousands of TOC rows) as they are consumed.
+    """
+    resolved = {}
+    texts = iter(texts)
+    while True:
+        batch = list(islice(texts, BATCH_SIZE))
+        if not batch:
+            return
+        
+        pending = {}
+        for text in batch:
+            if text not in resolved and text not in pending:
+                pending[text] = text.decode(encoding) if isinstance(text, bytes) else text
+        types = _type_codes(''.join(pending.values()))
+        offset = 0
+        for text, text_str in pending.items():
+            end = offset + len(text_str)
+            result = _display(text_str, types[offset:end]) if text_str else text_str
+            resolved[text] = result.encode(encoding) if isinstance(text, bytes) else result
+            offset = end
+        
+        for text in batch:
+            yield resolved[text]
+
+def _display(text_str, orig_types):
+    """Display order of a non-empty string given its type codes."""
+    # Step 1: Each character was classified once into orig_types; resolution
+    # works on parallel arrays of type codes and levels
+    base_level = _first_strong_level(orig_types)
+    
+    # Unidirectional text needs no resolution: without RTL characters the
+    # text displays as is, and RTL text without numbers, LTR characters or
+    # embeddings is every line reversed and mirrored
+    if not _RTL_TYPES.search(orig_types):
+        return text_str
+    if base_level == 1 and orig_types[0] != NSM and not _NON_RTL_TYPES.search(orig_types):
+        return _reverse_lines(text_str, orig_types)
+    
+    types = bytearray(orig_types)
+    levels = bytearray([base_level]) * len(text_str)
     
     # Step 2: Apply explicit embedding levels (X1-X9)
-    apply_explicit_levels(chars, base_level)
+    apply_explicit_levels(types, levels, base_level)
     
     # Step 3: Resolve weak types (W1-W7)
-    resolve_weak_types(chars)
+    resolve_weak_types(types)
     
     # Step 4: Resolve neutral types (N1-N2)  
-    resolve_neutral_types(chars)
+    resolve_neutral_types(types, levels)
     
     # Step 5: Resolve implicit levels (I1-I2)
-    resolve_implicit_levels(chars)
+    resolve_implicit_levels(types, levels)
     
-    # Step 6: Reorder levels (L1-L4)
-    reorder_levels(chars, base_level)
+    # Step 6: Reorder levels (L1-L4) into a permutation of character indexes
+    order = reorder_levels(orig_types, levels, base_level)
     
     # Step 7: Apply character mirroring (L4)
-    apply_mirroring(chars)
+    code_points = apply_mirroring(text_str, levels)
     
     # Build result
-    result = ''.join(char['char'] for char in chars)
-    
-    if return_bytes:
-        return result.encode(encoding)
-    return result
+    return array('I', map(code_points.__getitem__, order)).tobytes().decode('utf-32-le')
+
+def _pattern(*codes):
+    """Compiled regex matching runs of the given type codes in a type array."""
+    return re.compile(b'[' + b''.join(re.escape(bytes([code])) for code in codes) + b']+')
 
-def apply_explicit_levels(chars, base_level):
+_EXPLICIT_RUNS = _pattern(LRE, RLE, LRO, RLO, PDF)
+_RTL_TYPES = _pattern(R, AL, AN, LRE, RLE, LRO, RLO, PDF)
+_NON_RTL_TYPES = _pattern(L, EN, AN, LRE, RLE, LRO, RLO, PDF)
+_NSM_RUNS = _pattern(NSM)
+_EN_RUNS = _pattern(EN)
+_ET_RUNS = _pattern(ET)
+_STRONG_RUNS = _pattern(L, R)
+_STRONG_AL_RUNS = _pattern(L, R, AL)
+_NEUTRAL_RUNS = _pattern(B, S, WS, ON)
+_LEVEL_RUNS = {}
+_EN_SEPARATOR = re.compile(b'(?<=%s)[%s%s](?=%s)' % tuple(re.escape(bytes([code])) for code in (EN, ES, CS, EN)))
+_AN_SEPARATOR = re.compile(b'(?<=%s)%s(?=%s)' % tuple(re.escape(bytes([code])) for code in (AN, CS, AN)))
+
+def _translation(mapping):
+    table = bytearray(range(256))
+    for code, value in mapping.items():
+        table[code] = value
+    return bytes(table)
+
+_AL_TO_R = _translation({AL: R})
+_SEPARATORS_TO_ON = _translation({ET: ON, ES: ON, CS: ON})
+_PARITY_TO_TYPE = _translation({level: R if level & 1 else L for level in range(256)})
+# Level increments of I1 (even levels) and I2 (odd levels) by resolved type
+_EVEN_INCREMENT = _translation({code: {R: 1, AN: 2, EN: 2}.get(code, 0) for code in range(256)})
+_ODD_INCREMENT = _translation({code: {L: 1, AN: 1, EN: 1}.get(code, 0) for code in range(256)})
+
+def _level_runs(level):
+    """Compiled regex matching runs of levels greater than or equal to level."""
+    pattern = _LEVEL_RUNS.get(level)
+    if pattern is None:
+        pattern = _LEVEL_RUNS[level] = re.compile(b'[' + re.escape(bytes([level])) + b'-\\xff]+')
+    return pattern
+
+def apply_explicit_levels(types, levels, base_level):
     """Apply explicit embedding and override rules (X1-X9)."""
+    if not _EXPLICIT_RUNS.search(types):
+        return  # Every level stays at the base level
+    
     embedding_level = base_level
-    directional_override = None
+    directional_override = False
     level_stack = []
     
-    for char_info in chars:
-        bidi_type = char_info['type']
-        
-        if bidi_type in ('RLE', 'LRE', 'RLO', 'LRO'):
+    for i, bidi_type in enumerate(types):
+        if LRE <= bidi_type <= RLO:
             # Push current state
             if len(level_stack) < 61:  # Prevent overflow
                 level_stack.append((embedding_level, directional_override))
                 
-                if bidi_type in ('RLE', 'RLO'):
+                if bidi_type in (RLE, RLO):
                     new_level = (embedding_level + 1) | 1  # Next odd level
                 else:  # LRE, LRO
                     new_level = (embedding_level + 2) & ~1  # Next even level
                 
                 if new_level <= 62:
                     embedding_level = new_level
-                    directional_override = bidi_type[2] if bidi_type.endswith('O') else None
+                    directional_override = bidi_type in (LRO, RLO)
                 else:
                     level_stack.pop()  # Remove invalid push
+            continue
                     
-        elif bidi_type == 'PDF':
+        elif bidi_type == PDF:
             # Pop directional formatting
             if level_stack:
                 embedding_level, directional_override = level_stack.pop()
+            continue
                 
-        elif bidi_type == 'B':
+        elif bidi_type == B:
             # Paragraph separator resets everything
             level_stack.clear()
             embedding_level = base_level
-            directional_override = None
-            char_info['level'] = base_level
+            directional_override = False
+            
+        elif bidi_type == BN:
+            continue
             
         # Set character level and apply override
-        if bidi_type not in ('RLE', 'LRE', 'RLO', 'LRO', 'PDF', 'BN'):
-            char_info['level'] = embedding_level
-            if directional_override:
-                char_info['type'] = directional_override
+        levels[i] = embedding_level
+        if directional_override:
+            types[i] = OVERRIDDEN
     
-    # Remove explicit formatting characters (X9)
-    return [c for c in chars if c['type'] not in ('RLE', 'LRE', 'RLO', 'LRO', 'PDF', 'BN')]
+    # Explicit formatting characters keep their type and the base level (X9)
 
-def resolve_weak_types(chars):
+def resolve_weak_types(types):
     """Resolve weak type rules (W1-W7)."""
+    count = len(types)
+    
     # W1: NSM takes type of preceding character
-    prev_type = 'L'  # sor
-    for char_info in chars:
-        if char_info['type'] == 'NSM':
-            char_info['type'] = prev_type
-        prev_type = char_info['type']
+    for match in _NSM_RUNS.finditer(types):
+        start, end = match.span()
+        types[start:end] = bytes([types[start - 1] if start else L]) * (end - start)  # sor
     
     # W2: EN + prev AL -> AN
-    prev_strong = 'L'  # sor
-    for char_info in chars:
-        if char_info['type'] == 'EN' and prev_strong == 'AL':
-            char_info['type'] = 'AN'
-        if char_info['type'] in ('R', 'L', 'AL'):
-            prev_strong = char_info['type']
+    if AL in types and EN in types:
+        prev_strong = L  # sor
+        position = 0
+        for match in _EN_RUNS.finditer(types):
+            start, end = match.span()
+            for strong in _STRONG_AL_RUNS.finditer(types, position, start):
+                prev_strong = types[strong.end() - 1]
+            if prev_strong == AL:
+                types[start:end] = bytes([AN]) * (end - start)
+            position = end
     
     # W3: AL -> R
-    for char_info in chars:
-        if char_info['type'] == 'AL':
-            char_info['type'] = 'R'
+    types[:] = types.translate(_AL_TO_R)
     
     # W4: Single separator between same types
-    for i in range(1, len(chars) - 1):
-        curr = chars[i]
-        prev = chars[i - 1]
-        next_char = chars[i + 1]
-        
-        if curr['type'] == 'ES' and prev['type'] == 'EN' and next_char['type'] == 'EN':
-            curr['type'] = 'EN'
-        elif curr['type'] == 'CS' and prev['type'] == next_char['type'] and prev['type'] in ('AN', 'EN'):
-            curr['type'] = prev['type']
+    if ES in types or CS in types:
+        types[:] = _EN_SEPARATOR.sub(bytes([EN]), _AN_SEPARATOR.sub(bytes([AN]), types))
     
     # W5: ET adjacent to EN -> EN
-    for i in range(len(chars)):
-        if chars[i]['type'] == 'EN':
-            # Look backwards
-            j = i - 1
-            while j >= 0 and chars[j]['type'] == 'ET':
-                chars[j]['type'] = 'EN'
-                j -= 1
-            # Look forwards
-            j = i + 1
-            while j < len(chars) and chars[j]['type'] == 'ET':
-                chars[j]['type'] = 'EN'
-                j += 1
+    for match in _ET_RUNS.finditer(types):
+        start, end = match.span()
+        if (start and types[start - 1] == EN) or (end < count and types[end] == EN):
+            types[start:end] = bytes([EN]) * (end - start)
     
     # W6: Separators and terminators -> ON
-    for char_info in chars:
-        if char_info['type'] in ('ET', 'ES', 'CS'):
-            char_info['type'] = 'ON'
+    types[:] = types.translate(_SEPARATORS_TO_ON)
     
     # W7: EN + prev strong L -> L
-    prev_strong = 'L'  # sor
-    for char_info in chars:
-        if char_info['type'] == 'EN' and prev_strong == 'L':
-            char_info['type'] = 'L'
-        if char_info['type'] in ('L', 'R'):
-            prev_strong = char_info['type']
+    prev_strong = L  # sor
+    position = 0
+    for match in _EN_RUNS.finditer(types):
+        start, end = match.span()
+        for strong in _STRONG_RUNS.finditer(types, position, start):
+            prev_strong = types[strong.end() - 1]
+        if prev_strong == L:
+            types[start:end] = bytes([L]) * (end - start)
+        position = end
 
-def resolve_neutral_types(chars):
+def resolve_neutral_types(types, levels):
     """Resolve neutral type rules (N1-N2)."""
     # Find sequences of neutral characters
-    i = 0
-    while i < len(chars):
-        if chars[i]['type'] in ('B', 'S', 'WS', 'ON'):
-            # Found start of neutral sequence
-            seq_start = i
-            
-            # Find end of sequence
-            while i < len(chars) and chars[i]['type'] in ('B', 'S', 'WS', 'ON'):
-                i += 1
-            seq_end = i
-            
-            # Get surrounding types
-            prev_type = 'L' if seq_start == 0 else chars[seq_start - 1]['type']  # sor
-            next_type = 'L' if seq_end >= len(chars) else chars[seq_end]['type']  # eor
-            
-            # Convert AN/EN to R for comparison
-            if prev_type in ('AN', 'EN'):
-                prev_type = 'R'
-            if next_type in ('AN', 'EN'):
-                next_type = 'R'
-            
-            # N1: Same surrounding strong types
-            if prev_type == next_type and prev_type in ('L', 'R'):
-                for j in range(seq_start, seq_end):
-                    chars[j]['type'] = prev_type
-            else:
-                # N2: Use embedding direction
-                for j in range(seq_start, seq_end):
-                    chars[j]['type'] = 'L' if chars[j]['level'] % 2 == 0 else 'R'
+    count = len(types)
+    for match in _NEUTRAL_RUNS.finditer(types):
+        seq_start, seq_end = match.span()
+        
+        # Get surrounding types
+        prev_type = L if seq_start == 0 else types[seq_start - 1]  # sor
+        next_type = L if seq_end >= count else types[seq_end]  # eor
+        
+        # Convert AN/EN to R for comparison
+        if prev_type == AN or prev_type == EN:
+            prev_type = R
+        if next_type == AN or next_type == EN:
+            next_type = R
+        
+        # N1: Same surrounding strong types
+        if prev_type == next_type and (prev_type == L or prev_type == R):
+            types[seq_start:seq_end] = bytes([prev_type]) * (seq_end - seq_start)
         else:
-            i += 1
+            # N2: Use embedding direction
+            types[seq_start:seq_end] = levels[seq_start:seq_end].translate(_PARITY_TO_TYPE)
 
-def resolve_implicit_levels(chars):
+def resolve_implicit_levels(types, levels):
     """Resolve implicit levels (I1-I2)."""
-    for char_info in chars:
-        level = char_info['level']
-        bidi_type = char_info['type']
-        
-        if level % 2 == 0:  # Even (LTR) embedding level
+    level = levels[0]
+    if levels.count(level) == len(levels):
+        # A single embedding level: one table lookup per character
+        increments = types.translate(_ODD_INCREMENT if level & 1 else _EVEN_INCREMENT)
+        levels[:] = bytes(map(level.__add__, increments))
+        return
+    
+    for i, bidi_type in enumerate(types):
+        if levels[i] & 1 == 0:  # Even (LTR) embedding level
             # I1: R goes up one level, AN/EN go up two levels
-            if bidi_type == 'R':
-                char_info['level'] += 1
-            elif bidi_type in ('AN', 'EN'):
-                char_info['level'] += 2
+            if bidi_type == R:
+                levels[i] += 1
+            elif bidi_type == AN or bidi_type == EN:
+                levels[i] += 2
         else:  # Odd (RTL) embedding level
             # I2: L/AN/EN go up one level
-            if bidi_type in ('L', 'AN', 'EN'):
-                char_info['level'] += 1
+            if bidi_type == L or bidi_type == AN or bidi_type == EN:
+                levels[i] += 1
 
-def reorder_levels(chars, base_level):
-    """Reorder characters by level (L1-L2)."""
+def reorder_levels(orig_types, levels, base_level):
+    """Reorder characters by level (L1-L2) and return the display order as character indexes."""
+    count = len(orig_types)
+    
     # L1: Reset levels for paragraph/segment separators and trailing whitespace
-    for i in range(len(chars) - 1, -1, -1):
-        char_info = chars[i]
-        if char_info['orig_type'] in ('B', 'S'):
-            char_info['level'] = base_level
-        elif char_info['orig_type'] in ('WS', 'BN') and (i == len(chars) - 1 or chars[i + 1]['level'] == base_level):
-            char_info['level'] = base_level
+    for i in range(count - 1, -1, -1):
+        orig_type = orig_types[i]
+        if orig_type == B or orig_type == S:
+            levels[i] = base_level
+        elif (orig_type == WS or orig_type == BN) and (i == count - 1 or levels[i + 1] == base_level):
+            levels[i] = base_level
         else:
             break
     
     # L2: Process each line separately (split by paragraph separators)
+    order = array('I', range(count))
+    min_odd_level = base_level + 1 if base_level % 2 == 0 else base_level
     line_start = 0
-    for i in range(len(chars)):
-        # Check if this is a line break or end of text
-        if i == len(chars) - 1 or chars[i]['orig_type'] == 'B' or chars[i]['char'] == '\n':
-            line_end = i if chars[i]['orig_type'] == 'B' or chars[i]['char'] == '\n' else i + 1
-            
-            # Reorder this line only
-            if line_start < line_end:
-                line_chars = chars[line_start:line_end]
-                max_level = max(char['level'] for char in line_chars) if line_chars else base_level
-                min_odd_level = base_level + 1 if base_level % 2 == 0 else base_level
-                
-                for level in range(max_level, min_odd_level - 1, -1):
-                    j = 0
-                    while j < len(line_chars):
-                        if line_chars[j]['level'] >= level:
-                            # Found start of sequence to reverse
-                            start = j
-                            while j < len(line_chars) and line_chars[j]['level'] >= level:
-                                j += 1
-                            # Reverse the sequence
-                            line_chars[start:j] = reversed(line_chars[start:j])
-                        else:
-                            j += 1
-                
-                # Update the original chars array
-                chars[line_start:line_end] = line_chars
-            
-            # Move to next line
-            line_start = i + 1
+    while line_start < count:
+        line_end = orig_types.find(B, line_start)
+        if line_end < 0:
+            line_end = count
+        
+        # Reverse runs of the line's index permutation, from the highest
+        # level down; line_levels is permuted along with the indexes
+        if line_start < line_end:
+            line_order = order[line_start:line_end]
+            line_levels = levels[line_start:line_end]
+            for level in range(max(line_levels), min_odd_level - 1, -1):
+                for match in _level_runs(level).finditer(line_levels):
+                    start, end = match.span()
+                    line_order[start:end] = line_order[start:end][::-1]
+                    line_levels[start:end] = line_levels[start:end][::-1]
+            order[line_start:line_end] = line_order
+        
+        # Move to next line
+        line_start = line_end + 1
+    
+    return order
+
+_MIRROR_TABLE = str.maketrans(MIRRORED_CHARS)
+
+def _reverse_lines(text, types):
+    """Display order of RTL-only text: each line reversed and mirrored, separators in place."""
+    parts = []
+    start = 0
+    while True:
+        end = types.find(B, start)
+        if end < 0:
+            parts.append(text[start:][::-1].translate(_MIRROR_TABLE))
+            return ''.join(parts)
+        parts.append(text[start:end][::-1].translate(_MIRROR_TABLE))
+        parts.append(text[end])
+        start = end + 1
+
+_MIRRORED = re.compile('[' + re.escape(''.join(MIRRORED_CHARS)) + ']')
 
-def apply_mirroring(chars):
-    """Apply character mirroring (L4)."""
-    for char_info in chars:
-        if char_info['level'] % 2 == 1:  # RTL level
-            char = char_info['char']
-            if char in MIRRORED_CHARS:
-                char_info['char'] = MIRRORED_CHARS[char]
+def apply_mirroring(text, levels):
+    """Apply character mirroring (L4); returns the code points in logical order."""
+    code_points = array('I', text.encode('utf-32-le'))  # 'I' is 4 bytes on every supported platform
+    for match in _MIRRORED.finditer(text):
+        i = match.start()
+        if levels[i] & 1:  # RTL level
+            code_points[i] = ord(MIRRORED_CHARS[match.group()])
+    return code_points
@@ -0,0 +1,125 @@
+# coding: utf8
+import os
+import json
+
+from docx_cache import file_hash
+
+MANIFEST_VERSION = 1
+MANIFEST_SUFFIX = ".dindocs.json"
+
+def _stat(path):
+  stat = os.stat(path)
+  return stat.st_size, stat.st_mtime_ns
+
+class BuildManifest:
+  """Record of a generated bundle, used to rebuild only what changed.
+
+  Every segment of the output (main document, TOC, cover pages and
+  attachments) is stored with a content key, its page count and its page
+  offset. A segment whose key and offset are unchanged is copied from the
+  previous output instead of being rebuilt and renumbered. Options that
+  only change how the file is written (compress, linearize) don't affect the
+  segments, but an output written with other ones is never handed back as
+  unchanged.
+  """
+
+  def __init__(self, output_path, draft, enabled=True, compress=True, linearize=False):
+    self.output_path = output_path
+    self.path = output_path + MANIFEST_SUFFIX
+    self.draft = draft
+    self.compress = compress
+    self.linearize = linearize
+    self.previous = self._load() if enabled else None
+    self.sources = {}
+    self.segments = []
+    self.reused = 0
+    self.pages_by_hash = {}
+    self.segments_by_key = {}
+    self.keys = set()
+    if self.previous:
+      for record in self.previous["sources"].values():
+        self.pages_by_hash[record["hash"]] = record["pages"]
+      for segment in self.previous["segments"]:
+        self.segments_by_key[(segment["kind"], segment["key"], segment["offset"])] = segment
+        self.keys.add((segment["kind"], segment["key"]))
+
+  def _load(self):
+    """Load the previous manifest if it still describes the file on disk"""
+    try:
+      with open(self.path, "r", encoding="utf-8") as fp:
+        manifest = json.load(fp)
+      if manifest.get("version") != MANIFEST_VERSION or manifest.get("draft") != self.draft:
+        return None
+      if list(_stat(self.output_path)) != [manifest["output"]["size"], manifest["output"]["mtime"]]:
+        return None
+      return manifest
+    except (OSError, ValueError, KeyError, TypeError):
+      return None
+
+  @staticmethod
+  def _key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+  def source_hash(self, doc_path):
+    """Content hash of a source file, reusing the previous hash when size and mtime match"""
+    key = self._key(doc_path)
+    if key not in self.sources:
+      size, mtime = _stat(doc_path)
+      record = self.previous["sources"].get(key) if self.previous else None
+      if record and record["size"] == size and record["mtime"] == mtime:
+        digest = record["hash"]
+      else:
+        digest = file_hash(doc_path)
+      self.sources[key] = {"size": size, "mtime": mtime, "hash": digest, "pages": None}
+    return self.sources[key]["hash"]
+
+  def known_pages(self, doc_path):
+    """Page count of an unchanged source, or None when it has to be counted"""
+    record = self.sources[self._key(doc_path)]
+    if record["pages"] is None:
+      record["pages"] = self.pages_by_hash.get(record["hash"])
+    return record["pages"]
+
+  def set_pages(self, doc_path, pages):
+    self.sources[self._key(doc_path)]["pages"] = pages
+
+  def known(self, kind, key):
+    """True if the previous output has a segment with this content at any offset"""
+    return (kind, key) in self.keys
+
+  def reusable(self, kind, key, offset):
+    """Previous segment with the same content at the same offset, if any"""
+    return self.segments_by_key.get((kind, key, offset))
+
+  def add_segment(self, kind, key, offset, pages, reused):
+    self.segments.append({"kind": kind, "key": key, "offset": offset, "pages": pages})
+    if reused:
+      self.reused += 1
+
+  def unchanged(self):
+    """True when every segment matches the previous output exactly"""
+    return (bool(self.previous) and self.reused == len(self.segments) == len(self.previous["segments"])
+            and self.previous.get("compress") == self.compress and self.previous.get("linearize", False) == self.linearize)
+
+  def updated(self):
+    return self.previous["updated"] if self.previous else None
+
+  def save(self, updated):
+    size, mtime = _stat(self.output_path)
+    manifest = {
+      "version": MANIFEST_VERSION,
+      "draft": self.draft,
+      "compress": self.compress,
+      "linearize": self.linearize,
+      "updated": updated,
+      "output": {"size": size, "mtime": mtime},
+      "sources": self.sources,
+      "segments": self.segments,
+    }
+    temp_path = self.path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as fp:
+      json.dump(manifest, fp)
+    os.replace(temp_path, self.path)
+
+  def stats(self):
+    return {"reused": self.reused, "rebuilt": len(self.segments) - self.reused}
@@ -0,0 +1,399 @@
+# coding: utf8
+import io
+import zlib
+import struct
+import hashlib
+
+from PyPDF2.generic import (ArrayObject, DictionaryObject, IndirectObject, NameObject, NullObject,
+                            NumberObject, StreamObject, TextStringObject)
+
+OBJECTS_PER_STREAM = 100  # Non-stream objects packed into one compressed object stream
+
+class _Name(NameObject):
+  """NameObject that keeps its escaped form, which PyPDF2 rebuilds on every write"""
+
+  def write_to_stream(self, stream, encryption_key):
+    stream.write(self.encoded)
+
+_names = {}
+
+def _name(name):
+  cached = _names.get(name)
+  if cached is None:
+    cached = _names[name] = _Name(name)
+    cached.encoded = NameObject.renumber(cached)
+  return cached
+
+class BundleWriter:
+  """PDF writer that streams pages and their resources straight to a file.
+
+  Objects reachable from a page are written as soon as the page is, and
+  sources can be forgotten (and their readers closed) once their last pages
+  are out, so memory is bounded by the largest source rather than the
+  whole bundle. Only objects reachable from the pages (and the catalog
+  passed to close) are written, and streams with identical content -
+  including everything they reference - are written once and shared.
+  Links to pages outside the copied range are dropped. Outline items and
+  named destinations of a source are kept, as PdfWriter.append does, when
+  import_outline is called for its pages before the source is forgotten;
+  they are written by close.
+
+  With compress (the default), dictionaries and other non-stream objects
+  are packed into flate-compressed object streams, unfiltered streams
+  (page content, overlays) are deflated and the cross-reference table is
+  written as a compressed stream (PDF 1.5).
+
+  Provides the parts of the PdfWriter interface used by PageStamper
+  (_add_object and streaming), so pages can be stamped before they are
+  flushed.
+  """
+  streaming = True
+
+  def __init__(self, fp, compress=True):
+    self.fp = fp
+    self.compress = compress
+    self.offsets = {}
+    self.packed = {}  # Object number -> (object stream number, index in it)
+    self.pending = []  # (object number, serialized object) waiting for an object stream
+    self.translated = {}  # (id(source), source object number) -> object number here
+    self.digests = {}  # (id(source), source object number) -> content digest
+    self.streams = {}  # Stream content digest -> object number here
+    self.deduplicated = 0
+    self.page_refs = []
+    self.sources = {}  # id(source) -> (outline tree, named destinations) read from it
+    self.outline = []  # (title, page number here, view, closed, style, children)
+    self.dests = {}  # Destination name -> (page number here, view)
+    self.next_number = 1
+    self.pages_ref = IndirectObject(self._reserve(), 0, self)
+    fp.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+  def _reserve(self):
+    number = self.next_number
+    self.next_number += 1
+    return number
+
+  def _add_object(self, obj):
+    """Write a new object right away and return a reference to it"""
+    ref = IndirectObject(self._reserve(), 0, self)
+    self._write(ref.idnum, obj)
+    return ref
+
+  def _ref(self, ref, queue):
+    """Reference here for a source reference, queueing the object on first sight"""
+    if ref.pdf is self:
+      return ref
+    key = (id(ref.pdf), ref.idnum)
+    number = self.translated.get(key)
+    if number is None:
+      obj = ref.get_object()
+      if isinstance(obj, dict) and obj.get("/Type") in ("/Page", "/Pages"):
+        return NullObject()  # Page outside the copied range, or the source page tree
+      digest = self._digest(ref) if isinstance(obj, StreamObject) else None
+      number = self.streams.get(digest) if digest else None
+      if number is None:
+        number = self._reserve()
+        queue.append((number, obj))
+        if digest:
+          self.streams[digest] = number
+      else:
+        self.deduplicated += 1
+      self.translated[key] = number
+    return IndirectObject(number, 0, self)
+
+  # PyPDF2's object classes derive from a typing Protocol, which makes
+  # isinstance checks against them slow; the per-value paths below test
+  # the builtin base types (dict for dictionaries and streams, list for
+  # arrays) and the exact IndirectObject type instead
+
+  def _digest(self, obj, active=()):
+    """Hash of obj's content and everything it references; None if that reaches a page or a cycle"""
+    if type(obj) is IndirectObject:
+      if obj.pdf is self:
+        return b"R%d" % obj.idnum
+      key = (id(obj.pdf), obj.idnum)
+      if key in self.digests:
+        return self.digests[key]
+      if key in active:
+        return None
+      target = obj.get_object()
+      if isinstance(target, dict) and target.get("/Type") in ("/Page", "/Pages"):
+        digest = None
+      else:
+        digest = self._digest(target, active + (key,))
+      self.digests[key] = digest
+      return digest
+    if isinstance(obj, (dict, list)):
+      stream = isinstance(obj, StreamObject)
+      digest = hashlib.sha256(b"S" if stream else b"D" if isinstance(obj, dict) else b"A")
+      items = sorted(obj.items()) if isinstance(obj, dict) else enumerate(obj)
+      for key, value in items:
+        if stream and key == "/Length":
+          continue
+        value = self._digest(value, active)
+        if value is None:
+          return None
+        key = str(key).encode()
+        digest.update(b"%d:%s%d:%s" % (len(key), key, len(value), value))
+      if stream:
+        digest.update(obj._data)
+      return digest.digest()
+    return (type(obj).__name__ + repr(obj)).encode()
+
+  def _copy(self, obj, queue):
+    """Copy of obj with every indirect reference translated to this file"""
+    if type(obj) is IndirectObject:
+      return self._ref(obj, queue)
+    if isinstance(obj, dict):
+      stream = isinstance(obj, StreamObject)
+      if stream:
+        copy = StreamObject()
+        copy._data = obj._data
+      else:
+        copy = DictionaryObject()
+      for key, value in obj.items():
+        if stream and key == "/Length":
+          continue  # Set from the data when written
+        dict.__setitem__(copy, _name(key), self._copy(value, queue))  # Skips PdfObject checks, the values are copies
+      return copy
+    if isinstance(obj, list):
+      return ArrayObject([self._copy(value, queue) for value in obj])
+    if type(obj) is NameObject:
+      return _name(obj)
+    return obj
+
+  def _write(self, number, obj):
+    """Write obj and everything it references that is not written yet"""
+    queue = [(number, obj)]
+    while queue:
+      number, obj = queue.pop()
+      copy = self._copy(obj, queue)
+      if not self.compress:
+        self._write_object(number, copy)
+      elif isinstance(copy, StreamObject):
+        if "/Filter" not in copy:
+          data = zlib.compress(copy._data)
+          if len(data) < len(copy._data):
+            copy._data = data
+            copy[NameObject("/Filter")] = NameObject("/FlateDecode")
+        self._write_object(number, copy)
+      else:
+        packet = io.BytesIO()
+        copy.write_to_stream(packet, None)
+        self.pending.append((number, packet.getvalue()))
+        if len(self.pending) >= OBJECTS_PER_STREAM:
+          self._write_object_stream()
+
+  def _write_object(self, number, obj):
+    self.offsets[number] = self.fp.tell()
+    self.fp.write(b"%d 0 obj\n" % number)
+    obj.write_to_stream(self.fp, None)
+    self.fp.write(b"\nendobj\n")
+
+  def _write_object_stream(self):
+    """Pack the pending objects into one compressed object stream"""
+    if not self.pending:
+      return
+    stream_number = self._reserve()
+    header, body, offset = [], [], 0
+    for index, (number, data) in enumerate(self.pending):
+      header.append(b"%d %d" % (number, offset))
+      body.append(data)
+      offset += len(data) + 1
+      self.packed[number] = (stream_number, index)
+    header = b" ".join(header) + b"\n"
+    stream = StreamObject()
+    stream._data = zlib.compress(header + b"\n".join(body))
+    stream.update({
+      NameObject("/Type"): NameObject("/ObjStm"),
+      NameObject("/N"): NumberObject(len(self.pending)),
+      NameObject("/First"): NumberObject(len(header)),
+      NameObject("/Filter"): NameObject("/FlateDecode"),
+    })
+    self.pending = []
+    self._write_object(stream_number, stream)
+
+  def add_pages(self, reader, pages):
+    """Page dictionaries for reader pages in range pages=(start, stop), ready to be stamped"""
+    copies = []
+    for page_num in range(*pages):
+      page = reader.pages[page_num]
+      number = self._reserve()
+      self.translated[(id(reader), page.indirect_reference.idnum)] = number
+      copy = DictionaryObject(page)
+      copy[NameObject("/Parent")] = self.pages_ref
+      copies.append((number, copy))
+    return copies
+
+  def flush_pages(self, pages):
+    """Write pages from add_pages (and their resources) to the file"""
+    for number, page in pages:
+      self._write(number, page)
+      self.page_refs.append(IndirectObject(number, 0, self))
+
+  def append(self, reader, pages):
+    self.flush_pages(self.add_pages(reader, pages))
+
+  def _source_outline(self, reader):
+    """Outline items of reader as (destination, children) trees, and its named destinations"""
+    source = id(reader)
+    if source not in self.sources:
+      def tree(items):
+        nodes = []
+        for item in items:
+          if isinstance(item, list):
+            if nodes:
+              nodes[-1][1].extend(tree(item))
+          else:
+            nodes.append((item, []))
+        return nodes
+      outline = tree(reader.outline) if "/Outlines" in reader.trailer["/Root"] else []
+      self.sources[source] = outline, reader.named_destinations
+    return self.sources[source]
+
+  def import_outline(self, reader, pages):
+    """Keep the outline items and named destinations of reader that point into pages=(start, stop).
+
+    Call after add_pages for the same range. As with PdfWriter.append, the
+    items are added at the top level of the outline, keeping their children.
+    """
+    outline, named = self._source_outline(reader)
+    numbers = {}
+    for page_num in range(*pages):
+      idnum = reader.pages[page_num].indirect_reference.idnum
+      numbers[idnum] = self.translated[(id(reader), idnum)]
+
+    def target(dest):
+      page = dest.raw_get("/Page") if "/Page" in dest else None
+      ref = page if type(page) is IndirectObject else getattr(page, "indirect_reference", None)
+      return numbers.get(ref.idnum) if ref is not None else None
+
+    def view(dest):
+      return [_name(dest["/Type"])] + [dest[key] for key in ("/Left", "/Bottom", "/Right", "/Top", "/Zoom") if key in dest]
+
+    def keep(nodes):
+      kept = []
+      for dest, children in nodes:
+        number, children = target(dest), keep(children)
+        if number is not None or children:
+          kept.append((TextStringObject(dest.title), number, view(dest) if number is not None else None,
+                       dest.get("/Count", 0) < 0, (dest.get("/C"), dest.get("/F")), children))
+      return kept
+
+    self.outline.extend(keep(outline))
+    for name, dest in named.items():
+      number = target(dest)
+      if number is not None:
+        self.dests.setdefault(name, (number, view(dest)))
+
+  def forget(self, reader):
+    """Drop the object mapping of a source whose pages have all been written"""
+    source = id(reader)
+    self.translated = {key: number for key, number in self.translated.items() if key[0] != source}
+    self.digests = {key: digest for key, digest in self.digests.items() if key[0] != source}
+    self.sources.pop(source, None)
+
+  def _write_outline_items(self, items, parent):
+    """Write a level of outline items under parent; returns its first and last refs and open item count"""
+    refs = [IndirectObject(self._reserve(), 0, self) for _ in items]
+    count = len(items)
+    for index, (title, number, view, closed, (color, flags), children) in enumerate(items):
+      item = DictionaryObject({NameObject("/Title"): title, NameObject("/Parent"): parent})
+      if number is not None:
+        item[NameObject("/Dest")] = ArrayObject([IndirectObject(number, 0, self)] + view)
+      if color is not None:
+        item[NameObject("/C")] = color
+      if flags is not None:
+        item[NameObject("/F")] = flags
+      if index:
+        item[NameObject("/Prev")] = refs[index - 1]
+      if index + 1 < len(refs):
+        item[NameObject("/Next")] = refs[index + 1]
+      if children:
+        first, last, descendants = self._write_outline_items(children, refs[index])
+        item.update({NameObject("/First"): first, NameObject("/Last"): last,
+                     NameObject("/Count"): NumberObject(-descendants if closed else descendants)})
+        if not closed:
+          count += descendants
+      self._write(refs[index].idnum, item)
+    return refs[0], refs[-1], count
+
+  def close(self, catalog=None):
+    """Write the page tree, catalog, cross-reference table and trailer.
+
+    Entries of catalog (e.g. the outline of a PdfWriter whose pages were
+    appended) other than the page tree are carried over.
+    """
+    self._write(self.pages_ref.idnum, DictionaryObject({
+      NameObject("/Type"): NameObject("/Pages"),
+      NameObject("/Kids"): ArrayObject(self.page_refs),
+      NameObject("/Count"): NumberObject(len(self.page_refs)),
+    }))
+    root = DictionaryObject()
+    if catalog:
+      root.update((NameObject(key), value) for key, value in catalog.items())
+    root[NameObject("/Type")] = NameObject("/Catalog")
+    root[NameObject("/Pages")] = self.pages_ref
+    if self.outline:
+      outlines_ref = IndirectObject(self._reserve(), 0, self)
+      first, last, count = self._write_outline_items(self.outline, outlines_ref)
+      self._write(outlines_ref.idnum, DictionaryObject({
+        NameObject("/Type"): NameObject("/Outlines"),
+        NameObject("/First"): first, NameObject("/Last"): last, NameObject("/Count"): NumberObject(count),
+      }))
+      root[NameObject("/Outlines")] = outlines_ref
+    if self.dests:
+      names = ArrayObject()
+      for name, (number, view) in sorted(self.dests.items()):
+        names.extend([TextStringObject(name), ArrayObject([IndirectObject(number, 0, self)] + view)])
+      root[NameObject("/Names")] = DictionaryObject({NameObject("/Dests"): DictionaryObject({NameObject("/Names"): names})})
+    root = self._add_object(root)
+    if self.compress:
+      self._write_object_stream()
+      self._write_xref_stream(root)
+      return
+
+    xref = self.fp.tell()
+    self.fp.write(b"xref\n0 %d\n" % self.next_number)
+    self.fp.write(b"0000000000 65535 f\r\n")
+    for number in range(1, self.next_number):
+      offset = self.offsets.get(number)
+      self.fp.write(b"%010d 00000 n\r\n" % offset if offset is not None else b"0000000000 00000 f\r\n")
+    self.fp.write(b"trailer\n")
+    DictionaryObject({
+      NameObject("/Size"): NumberObject(self.next_number),
+      NameObject("/Root"): root,
+    }).write_to_stream(self.fp, None)
+    self.fp.write(b"\nstartxref\n%d\n%%%%EOF\n" % xref)
+
+  def _write_xref_stream(self, root):
+    """Cross-reference stream (with the trailer entries) covering direct and packed objects"""
+    xref_number = self._reserve()
+    xref = self.fp.tell()
+    self.offsets[xref_number] = xref
+    entries = [struct.pack(">BIH", 0, 0, 65535)]
+    for number in range(1, self.next_number):
+      if number in self.offsets:
+        entries.append(struct.pack(">BIH", 1, self.offsets[number], 0))
+      elif number in self.packed:
+        entries.append(struct.pack(">BIH", 2, *self.packed[number]))
+      else:
+        entries.append(struct.pack(">BIH", 0, 0, 0))
+    stream = StreamObject()
+    stream._data = zlib.compress(b"".join(entries))
+    stream.update({
+      NameObject("/Type"): NameObject("/XRef"),
+      NameObject("/Size"): NumberObject(self.next_number),
+      NameObject("/W"): ArrayObject([NumberObject(1), NumberObject(4), NumberObject(2)]),
+      NameObject("/Root"): root,
+      NameObject("/Filter"): NameObject("/FlateDecode"),
+    })
+    self.fp.write(b"%d 0 obj\n" % xref_number)
+    stream.write_to_stream(self.fp, None)
+    self.fp.write(b"\nendobj\nstartxref\n%d\n%%%%EOF\n" % xref)
+
+  def stats(self):
+    return {
+      "objects": len(self.offsets) + len(self.packed),
+      "objectStreams": len({stream for stream, _ in self.packed.values()}),
+      "streamsDeduplicated": self.deduplicated,
+    }
@@ -0,0 +1,58 @@
+# coding: utf8
+import os
+
+class DocumentRegistry:
+  """Per-job registry that parses every input PDF once and shares the reader.
+
+  The same reader is used for page counting, merging and stamping; repeated
+  requests for a path are counted as avoided parses.
+  """
+
+  def __init__(self):
+    self.readers = {}
+    self.files = {}
+    self.parsed = 0
+    self.reused = 0
+
+  @staticmethod
+  def _key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+  def open(self, path):
+    """Return the reader for path, parsing the file only on first use"""
+    key = self._key(path)
+    reader = self.readers.get(key)
+    if reader is None:
+      from PyPDF2 import PdfReader
+      fp = open(path, "rb")
+      try:
+        reader = PdfReader(fp)
+      except Exception:
+        fp.close()
+        raise
+      self.files[key] = fp
+      self.readers[key] = reader
+      self.parsed += 1
+    else:
+      self.reused += 1
+    return reader
+
+  def page_count(self, path):
+    return len(self.open(path).pages)
+
+  def release(self, path):
+    """Close path's file and drop its reader once no more pages are needed from it"""
+    key = self._key(path)
+    fp = self.files.pop(key, None)
+    if fp:
+      fp.close()
+    return self.readers.pop(key, None)
+
+  def close(self):
+    for fp in self.files.values():
+      fp.close()
+    self.files.clear()
+    self.readers.clear()
+
+  def stats(self):
+    return {"parsed": self.parsed, "parsesAvoided": self.reused}
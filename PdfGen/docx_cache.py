@@ -0,0 +1,171 @@
+# coding: utf8
+import os
+import json
+import time
+import shutil
+import hashlib
+
+CACHE_LIMIT = 1024 * 1024 * 1024  # Bytes of converted PDFs kept on disk
+INDEX_FILE = "index.json"
+TRIM_LOCK = "trim.lock"
+STALE_LOCK = 600  # Seconds after which a trim lock is taken to be left by a process that died
+
+def cache_root():
+  """Per-user cache folder (LOCALAPPDATA on Windows, XDG cache elsewhere)"""
+  root = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+  return os.path.join(root, "din.docs")
+
+def default_cache_dir():
+  return os.path.join(cache_root(), "docx_cache")
+
+def file_hash(path):
+  sha = hashlib.sha256()
+  with open(path, "rb") as fp:
+    for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+      sha.update(chunk)
+  return sha.hexdigest()
+
+class DocxCache:
+  """Persistent cache of converted DOCX files keyed by content hash.
+
+  A stat record (size + mtime) per source path lets unchanged files skip
+  hashing. Converted PDFs are kept under a size cap and evicted least
+  recently used first. Several processes can share the folder: a job only
+  reads its own link or copy of a cached PDF, and one process at a time
+  evicts.
+  """
+
+  def __init__(self, cache_dir=None, max_bytes=CACHE_LIMIT):
+    self.dir = cache_dir or default_cache_dir()
+    self.max_bytes = max_bytes
+    self.index_path = os.path.join(self.dir, INDEX_FILE)
+    os.makedirs(self.dir, exist_ok=True)
+    self.index = self._load()
+    self.hits = 0
+    self.misses = 0
+
+  def _load(self):
+    try:
+      with open(self.index_path, "r", encoding="utf-8") as fp:
+        index = json.load(fp)
+      if isinstance(index.get("files"), dict) and isinstance(index.get("entries"), dict):
+        return index
+    except (OSError, ValueError):
+      pass
+    return {"files": {}, "entries": {}}
+
+  def digest(self, doc_path):
+    """Content hash of doc_path, skipping the read when size and mtime match"""
+    key = os.path.normcase(os.path.abspath(doc_path))
+    stat = os.stat(doc_path)
+    record = self.index["files"].get(key)
+    if record and record["size"] == stat.st_size and record["mtime"] == stat.st_mtime_ns:
+      return record["hash"]
+    digest = file_hash(doc_path)
+    self.index["files"][key] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest}
+    return digest
+
+  def _pdf_path(self, digest):
+    return os.path.join(self.dir, digest + ".pdf")
+
+  def _take(self, source, target):
+    """Hard link source to target, or copy it where links aren't possible"""
+    try:
+      os.link(source, target)
+    except FileExistsError:
+      pass  # Taken already for another file with the same content
+    except FileNotFoundError:
+      raise
+    except OSError:
+      shutil.copyfile(source, target)
+
+  def lookup(self, doc_path, copy_dir=None):
+    """Return doc_path's content hash and its cached PDF, or None on a miss
+
+    With copy_dir the PDF returned is a link or copy in copy_dir, which
+    another process evicting the entry can't take away. An entry that is
+    gone meanwhile is a miss. A miss's hash is what store() takes after
+    converting: hashing the file again then could file the PDF of the old
+    content under a newer save.
+    """
+    digest = self.digest(doc_path)
+    pdf_path = self._pdf_path(digest)
+    entry = self.index["entries"].get(digest)
+    if entry:
+      try:
+        if copy_dir:
+          self._take(pdf_path, os.path.join(copy_dir, digest + ".pdf"))
+          pdf_path = os.path.join(copy_dir, digest + ".pdf")
+        elif not os.path.exists(pdf_path):
+          raise FileNotFoundError(pdf_path)
+        entry["used"] = time.time()
+        self.hits += 1
+        return digest, pdf_path
+      except FileNotFoundError:
+        pass  # Evicted by another process
+    self.misses += 1
+    return digest, None
+
+  def store(self, digest, pdf_path):
+    """Add a freshly converted PDF to the cache under the hash lookup() gave; pdf_path itself stays in place"""
+    cached_path = self._pdf_path(digest)
+    if not os.path.exists(cached_path):
+      temp_path = "{}.{}.tmp".format(cached_path, os.getpid())
+      self._take(pdf_path, temp_path)
+      os.replace(temp_path, cached_path)
+    self.index["entries"][digest] = {"size": os.path.getsize(pdf_path), "used": time.time()}
+
+  def trim(self):
+    """Evict least recently used entries until the cache fits max_bytes.
+
+    Skipped while another process holds the trim lock; the cache is trimmed
+    again after its next job.
+    """
+    lock_path = os.path.join(self.dir, TRIM_LOCK)
+    try:
+      fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+      try:
+        if time.time() - os.path.getmtime(lock_path) > STALE_LOCK:
+          os.remove(lock_path)
+      except OSError:
+        pass
+      return
+    try:
+      self._evict()
+    finally:
+      os.close(fd)
+      os.remove(lock_path)
+
+  def _evict(self):
+    entries = self.index["entries"]
+    total = sum(entry["size"] for entry in entries.values())
+    for digest in sorted(entries, key=lambda digest: entries[digest]["used"]):
+      if total <= self.max_bytes:
+        break
+      try:
+        os.remove(self._pdf_path(digest))
+      except FileNotFoundError:
+        pass
+      except OSError:
+        continue  # Still open by another process, try again next time
+      total -= entries.pop(digest)["size"]
+    hashes = set(entries)
+    self.index["files"] = {key: record for key, record in self.index["files"].items() if record["hash"] in hashes}
+
+  def save(self):
+    """Write the index, merging entries recorded by other processes meanwhile"""
+    on_disk = self._load()
+    for digest, entry in on_disk["entries"].items():
+      if digest not in self.index["entries"] and os.path.exists(self._pdf_path(digest)):
+        self.index["entries"][digest] = entry
+    for key, record in on_disk["files"].items():
+      if record["hash"] in self.index["entries"]:
+        self.index["files"].setdefault(key, record)
+    temp_path = "{}.{}.tmp".format(self.index_path, os.getpid())
+    with open(temp_path, "w", encoding="utf-8") as fp:
+      json.dump(self.index, fp)
+    os.replace(temp_path, self.index_path)
+
+  def stats(self):
+    return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,167 @@
+# coding: utf8
+import io
+import os
+import json
+from collections import defaultdict
+from pathlib import Path
+
+from docx_cache import cache_root, file_hash
+
+FONT_CACHE_VERSION = 1
+
+_fonts = {}  # Font path -> parsed metrics, shared by every FPDF in the process
+
+def default_cache_dir():
+  return os.path.join(cache_root(), "font_cache")
+
+class _ParsedFont:
+  """Metrics and glyph tables of one TTF file, read once and reused per document"""
+
+  def __init__(self, stat, data, metrics):
+    self.stat = stat
+    self.data = data
+    self.metrics = metrics
+    self.cw = {int(char): width for char, width in metrics["cw"].items()}
+    self.cmap = {int(char): glyph for char, glyph in metrics["cmap"].items()}
+    self.glyph_ids = {int(char): glyph_id for char, glyph_id in metrics["glyph_ids"].items()}
+    self.usable = True
+
+def _metrics(font):
+  """JSON-serializable copy of what TTFFont parses out of the font tables"""
+  desc = font.desc
+  return {
+    "version": FONT_CACHE_VERSION,
+    "scale": font.scale, "name": font.name,
+    "up": font.up, "ut": font.ut, "sp": font.sp, "ss": font.ss,
+    "desc": [desc.ascent, desc.descent, desc.cap_height, desc.flags.value, desc.font_b_box,
+             desc.italic_angle, desc.stem_v, desc.missing_width],
+    "cw": dict(font.cw), "cmap": font.cmap, "glyph_ids": font.glyph_ids,
+  }
+
+def _cacheable(font_path):
+  """Fonts fpdf has to patch (compressed, CFF, symbol, missing .notdef) are always parsed"""
+  from fontTools import ttLib
+  if not font_path.lower().endswith(".ttf"):
+    return False
+  ttfont = ttLib.TTFont(font_path, lazy=True)
+  try:
+    return "glyf" in ttfont and ".notdef" in ttfont["glyf"] and ttfont.getBestCmap()
+  finally:
+    ttfont.close()
+
+def _parsed_font(pdf, family, style, font_path, cache_dir):
+  """Parsed metrics for font_path, from memory, the sidecar file or a fresh parse"""
+  key = os.path.normcase(os.path.abspath(font_path))
+  stat = os.stat(font_path)
+  stat = (stat.st_size, stat.st_mtime_ns)
+  parsed = _fonts.get(key)
+  if parsed and parsed.stat == stat:
+    return parsed
+
+  from fpdf import __version__ as fpdf_version
+  with open(font_path, "rb") as fp:
+    data = fp.read()
+  # What TTFFont parses differs between fpdf2 versions, so each keeps its own sidecar
+  sidecar = os.path.join(cache_dir, "{}-fpdf{}.json".format(file_hash(font_path), fpdf_version))
+  try:
+    with open(sidecar, "r", encoding="utf-8") as fp:
+      metrics = json.load(fp)
+    if metrics.get("version") != FONT_CACHE_VERSION:
+      metrics = None
+  except (OSError, ValueError):
+    metrics = None
+
+  if metrics is None:
+    if not _cacheable(font_path):
+      return None
+    pdf.add_font(family, style, font_path)
+    metrics = _metrics(pdf.fonts[family.lower() + style])
+    try:
+      os.makedirs(cache_dir, exist_ok=True)
+      temp_path = "{}.{}.tmp".format(sidecar, os.getpid())
+      with open(temp_path, "w", encoding="utf-8") as fp:
+        json.dump(metrics, fp)
+      os.replace(temp_path, sidecar)
+    except OSError:
+      pass  # The cache is only an optimization
+  _fonts[key] = parsed = _ParsedFont(stat, data, metrics)
+  try:
+    _probe(family, style, font_path, parsed)
+  except Exception:
+    # The font object is assembled from fpdf2 2.8 internals; where they
+    # differ fpdf parses the font itself, for the rest of the process
+    parsed.usable = False
+  return parsed
+
+def _font_object(pdf, fontkey, style, font_path, parsed):
+  """TTFFont for one document, built from parsed metrics instead of the font tables"""
+  from fontTools import ttLib
+  from fpdf.enums import FontDescriptorFlags, TextEmphasis
+  from fpdf.fonts import PDFFontDescriptor, SubsetMap, TTFFont, get_color_font_object
+
+  metrics = parsed.metrics
+  ascent, descent, cap_height, flags, font_b_box, italic_angle, stem_v, missing_width = metrics["desc"]
+  font = TTFFont.__new__(TTFFont)
+  font.i = len(pdf.fonts) + 1
+  font.type = "TTF"
+  font.ttffile = Path(font_path)
+  font.is_compressed = False
+  font._hbfont = None
+  font.fontkey = fontkey
+  font.biggest_size_pt = 0
+  font.collection_font_number = 0
+  # fpdf subsets the font tables in place on output, so every document gets its own TTFont
+  font.ttfont = ttLib.TTFont(io.BytesIO(parsed.data), recalcTimestamp=False, lazy=True)
+  font.is_cff = False
+  font.is_cid_keyed = False
+  font.is_symbol = False
+  font.cff_ros = None
+  font.scale = metrics["scale"]
+  font.desc = PDFFontDescriptor(
+    ascent=ascent, descent=descent, cap_height=cap_height, flags=FontDescriptorFlags(flags),
+    font_b_box=font_b_box, italic_angle=italic_angle, stem_v=stem_v, missing_width=missing_width)
+  font.cw = defaultdict(lambda: missing_width, parsed.cw)
+  font.cmap = parsed.cmap
+  font.glyph_ids = dict(parsed.glyph_ids)
+  font.missing_glyphs = []
+  font.name = metrics["name"]
+  font.up, font.ut, font.sp, font.ss = metrics["up"], metrics["ut"], metrics["sp"], metrics["ss"]
+  font.emphasis = TextEmphasis.coerce(style)
+  font.subset = SubsetMap(font)
+  font.palette_index = 0
+  font.color_font = get_color_font_object(pdf, font, 0) if pdf.render_color_fonts else None
+  return font
+
+def _probe(family, style, font_path, parsed):
+  """Render a glyph with a font object built from parsed metrics, all the way to the PDF.
+
+  Raises when fpdf2's internals don't match what _font_object sets, here
+  rather than in a job's output.
+  """
+  from fpdf import FPDF
+  pdf = FPDF()
+  fontkey = family.lower() + style
+  pdf.fonts[fontkey] = _font_object(pdf, fontkey, style, font_path, parsed)
+  pdf.add_page()
+  pdf.set_font(family, style, 12)
+  pdf.cell(text=chr(next(char for char in sorted(parsed.cmap) if char > 0x20)))
+  pdf.output()
+
+def add_font(pdf, family, font_path, style="", cache_dir=None):
+  """FPDF.add_font that parses each font file once per process.
+
+  The parsed metrics are also kept in a sidecar file named after the font's
+  content hash, so a new process skips TTF parsing as well. Only the font
+  object itself (subset, glyph usage) is created per document; the first
+  one of a process is rendered to a scratch PDF to check it.
+  """
+  style = "".join(sorted(style.upper()))
+  fontkey = family.lower() + style
+  if fontkey in pdf.fonts:
+    return
+  parsed = _parsed_font(pdf, family, style, font_path, cache_dir or default_cache_dir())
+  if parsed is None or not parsed.usable:
+    pdf.add_font(family, style, font_path)
+  if fontkey in pdf.fonts:
+    return  # Parsed just now by fpdf itself
+  pdf.fonts[fontkey] = _font_object(pdf, fontkey, style, font_path, parsed)
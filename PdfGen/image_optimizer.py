@@ -0,0 +1,124 @@
+# coding: utf8
+import io
+import os
+
+IMAGE_DPI = 150
+IMAGE_QUALITY = 75
+DPI_TOLERANCE = 1.1  # Images up to 10% over the target are left alone
+
+_COLOR_MODES = {"/DeviceGray": "L", "/DeviceRGB": "RGB"}
+_ICC_MODES = {1: "L", 3: "RGB"}
+
+def _mode(image):
+  """Pillow mode for an 8-bit gray or RGB image, None for anything else"""
+  if image.get("/BitsPerComponent") != 8:
+    return None
+  color_space = image.get("/ColorSpace")
+  if color_space is None:
+    return None
+  color_space = color_space.get_object()
+  if isinstance(color_space, list):
+    if len(color_space) != 2 or color_space[0] != "/ICCBased":
+      return None
+    return _ICC_MODES.get(color_space[1].get_object().get("/N"))
+  return _COLOR_MODES.get(color_space)
+
+def _decode(image, mode):
+  """Pillow image for a PDF image XObject, None if its encoding isn't supported"""
+  from PIL import Image
+  filters = image.get("/Filter")
+  if filters is not None:
+    filters = filters.get_object()
+    filters = list(filters) if isinstance(filters, list) else [filters]
+  if filters in (None, [], ["/FlateDecode"]):
+    return Image.frombytes(mode, (image["/Width"], image["/Height"]), image.get_data())
+  if filters == ["/DCTDecode"]:
+    decoded = Image.open(io.BytesIO(image._data))
+    return decoded if decoded.mode == mode else None  # CMYK/YCCK JPEGs keep their encoding
+  return None  # Bilevel (CCITT, JBIG2) and JPX scans are already compact
+
+def _recompress(image, dpi, target_dpi, quality):
+  """JPEG data and size for an image downsampled to the target DPI, None to keep it"""
+  if image.get("/ImageMask") or "/Mask" in image or "/Decode" in image:
+    return None
+  mode = _mode(image)
+  if mode is None:
+    return None
+  decoded = _decode(image, mode)
+  if decoded is None:
+    return None
+  from PIL import Image
+  scale = target_dpi / dpi
+  size = (max(1, round(decoded.width * scale)), max(1, round(decoded.height * scale)))
+  packet = io.BytesIO()
+  decoded.resize(size, Image.LANCZOS).save(packet, "JPEG", quality=quality, optimize=True)
+  data = packet.getvalue()
+  return (data, size) if len(data) < len(image._data) else None
+
+def _page_images(resources, seen):
+  """Image XObjects used by a page's resources, including those inside form XObjects"""
+  if resources is None:
+    return
+  xobjects = resources.get_object().get("/XObject")
+  if not xobjects:
+    return
+  for ref in xobjects.get_object().values():
+    if ref.idnum in seen:
+      continue
+    seen.add(ref.idnum)
+    xobject = ref.get_object()
+    if xobject.get("/Subtype") == "/Image":
+      yield xobject
+    elif xobject.get("/Subtype") == "/Form" and "/Resources" in xobject:
+      yield from _page_images(xobject["/Resources"], seen)
+
+def optimize_images(pdf_path, output_path, dpi=IMAGE_DPI, quality=IMAGE_QUALITY):
+  """Downsample raster images above dpi to JPEG at the given quality.
+
+  Runs in a worker process, one attachment per call. The effective DPI of
+  an image is taken against the page it is on (long side to long side),
+  which underestimates it for images smaller than the page, so only truly
+  oversized images are touched; an image is replaced only when the new
+  encoding is smaller. output_path is written only if some image shrank.
+  """
+  from PyPDF2 import PdfReader, PdfWriter
+  from PyPDF2.generic import NameObject, NumberObject
+
+  stats = {"bytesBefore": os.path.getsize(pdf_path), "images": 0, "optimized": 0}
+  writer = PdfWriter()
+  with open(pdf_path, "rb") as fp:
+    writer.append(PdfReader(fp))
+  seen = set()
+  for page in writer.pages:
+    box = page.mediabox
+    page_inches = max(float(box.width), float(box.height)) / 72
+    for image in _page_images(page.get("/Resources"), seen):
+      stats["images"] += 1
+      image_dpi = max(image["/Width"], image["/Height"]) / page_inches
+      if image_dpi <= dpi * DPI_TOLERANCE:
+        continue
+      recompressed = _recompress(image, image_dpi, dpi, quality)
+      if recompressed is None:
+        continue
+      data, (width, height) = recompressed
+      image._data = data
+      if hasattr(image, "decoded_self"):
+        image.decoded_self = None
+      image[NameObject("/Filter")] = NameObject("/DCTDecode")
+      image[NameObject("/Width")] = NumberObject(width)
+      image[NameObject("/Height")] = NumberObject(height)
+      if "/DecodeParms" in image:
+        del image["/DecodeParms"]
+      stats["optimized"] += 1
+
+  stats["bytesAfter"] = stats["bytesBefore"]
+  stats["path"] = None
+  if stats["optimized"]:
+    with open(output_path, "wb") as fp:
+      writer.write(fp)
+    size = os.path.getsize(output_path)
+    if size < stats["bytesBefore"]:
+      stats["bytesAfter"] = size
+      stats["path"] = output_path
+  stats["bytesSaved"] = stats["bytesBefore"] - stats["bytesAfter"]
+  return stats
@@ -0,0 +1,292 @@
+# coding: utf8
+import tempfile
+
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NullObject, StreamObject
+
+XREF_ENTRY = b"%010d 00000 n\r\n"
+FREE_ENTRY = b"0000000000 65535 f\r\n"
+
+def _refs(obj):
+  """Indirect references directly inside obj (not through other indirect objects)"""
+  stack = [obj]
+  while stack:
+    obj = stack.pop()
+    if type(obj) is IndirectObject:
+      yield obj
+    elif isinstance(obj, dict):
+      stack.extend(obj.values())
+    elif isinstance(obj, list):
+      stack.extend(obj)
+
+def _is_page_node(obj):
+  return isinstance(obj, dict) and obj.get("/Type") in ("/Page", "/Pages")
+
+class _Bits:
+  """Big-endian bit writer for the hint tables"""
+
+  def __init__(self):
+    self.data = bytearray()
+    self.value = 0
+    self.count = 0
+
+  def write(self, value, bits):
+    for bit in range(bits - 1, -1, -1):
+      self.value = self.value << 1 | (value >> bit) & 1
+      self.count += 1
+      if self.count == 8:
+        self.data.append(self.value)
+        self.value = self.count = 0
+
+  def flush(self):
+    """Pad to a byte boundary; every item of a hint table starts on one"""
+    if self.count:
+      self.write(0, 8 - self.count)
+
+class _Linearizer:
+  """Reorders a PDF into the linearized layout of ISO 32000-1 Annex F.
+
+  The file is laid out as header, linearization dictionary, first-page
+  cross-reference section, catalog, primary hint stream, first page (page
+  object first, then everything it uses), the other pages with the objects
+  only they use, objects shared by several pages, the remaining document
+  objects (page tree, outline) and the main cross-reference section.
+  Objects are written one by one to a spool file with their final numbers,
+  then copied into place once the layout - and with it every offset in the
+  linearization dictionary and hint tables - is known.
+  """
+
+  def __init__(self, reader):
+    self.reader = reader
+    self.catalog_ref = reader.trailer.raw_get("/Root")
+    self.page_refs = [page.indirect_reference for page in reader.pages]
+
+  def _key(self, ref):
+    return ref.idnum, ref.generation
+
+  def _collect(self, start, seen):
+    """start and the objects reachable from it that are not in seen or page tree nodes, in discovery order"""
+    found = []
+    stack = [start]
+    while stack:
+      ref = stack.pop()
+      key = self._key(ref)
+      if key in seen:
+        continue
+      obj = ref.get_object()
+      if obj is None or (found and _is_page_node(obj)):
+        continue
+      seen.add(key)
+      found.append(key)
+      stack.extend(reversed(list(_refs(obj))))
+    return found
+
+  def _page_tree(self):
+    """References of the page tree nodes"""
+    nodes = []
+    stack = [self.catalog_ref.get_object().raw_get("/Pages")]
+    while stack:
+      ref = stack.pop()
+      node = ref.get_object()
+      if node.get("/Type") == "/Pages":
+        nodes.append(ref)
+        stack.extend(reversed(node.get("/Kids", [])))
+    return nodes
+
+  def plan(self):
+    """Split objects into the linearized parts and number them"""
+    users = {}  # Object -> pages using it, in page order
+    page_objects = []
+    for page_num, ref in enumerate(self.page_refs):
+      used = self._collect(ref, set())
+      page_objects.append(used)
+      for key in used:
+        users.setdefault(key, []).append(page_num)
+
+    # Page 1 takes everything it uses; later pages only what no other page
+    # uses, the rest goes to the shared objects section
+    self.first_page = page_objects[0]
+    in_first = set(self.first_page)
+    self.pages = [self.first_page]
+    self.shared = []
+    for page_num, used in enumerate(page_objects[1:], 1):
+      self.pages.append([key for key in used if key not in in_first and len(users[key]) == 1])
+      self.shared.extend(key for key in used if key not in in_first and len(users[key]) > 1 and users[key][0] == page_num)
+    self.page_shared = [[]] + [[key for key in used if key in in_first or len(users[key]) > 1] for used in page_objects[1:]]
+
+    catalog = self._key(self.catalog_ref)
+    seen = set(users)
+    self.other = self._collect(self.catalog_ref, seen)[1:]
+    for ref in self._page_tree():
+      self.other.extend(self._collect(ref, seen))
+
+    # Main section (parts 7-9) gets 1..m, the first-page section the numbers after it
+    main = [key for page in self.pages[1:] for key in page] + self.shared + self.other
+    self.numbers = {key: number for number, key in enumerate(main, 1)}
+    self.main_count = len(main)
+    number = self.main_count + 1
+    self.lin_number, self.catalog_number, self.hint_number = number, number + 1, number + 2
+    self.numbers[catalog] = self.catalog_number
+    for offset, key in enumerate(self.first_page, number + 3):
+      self.numbers[key] = offset
+    self.size = number + 3 + len(self.first_page)
+
+  def _copy(self, obj):
+    if type(obj) is IndirectObject:
+      number = self.numbers.get(self._key(obj))
+      return IndirectObject(number, 0, None) if number else NullObject()
+    if isinstance(obj, dict):
+      stream = isinstance(obj, StreamObject)
+      if stream:
+        copy = StreamObject()
+        copy._data = obj._data
+      else:
+        copy = DictionaryObject()
+      for key, value in obj.items():
+        if not (stream and key == "/Length"):
+          dict.__setitem__(copy, key, self._copy(value))
+      return copy
+    if isinstance(obj, list):
+      return ArrayObject([self._copy(value) for value in obj])
+    return obj
+
+  def _spool(self, spool, key):
+    """Write an object to the spool with its final number, return its length"""
+    start = spool.tell()
+    spool.write(b"%d 0 obj\n" % self.numbers[key])
+    self._copy(IndirectObject(key[0], key[1], self.reader).get_object()).write_to_stream(spool, None)
+    spool.write(b"\nendobj\n")
+    return spool.tell() - start
+
+  def _hint_stream(self, page_lengths, first_page_location, shared_lengths, shared_location):
+    """Page offset and shared object hint tables (offsets as if the hint stream were absent)"""
+    bits = _Bits()
+    counts = [len(self.first_page)] + [len(page) for page in self.pages[1:]]
+    shared_ids = {key: index for index, key in enumerate(self.first_page + self.shared)}
+    least_count, least_length = min(counts), min(page_lengths)
+    count_bits = (max(counts) - least_count).bit_length()
+    length_bits = (max(page_lengths) - least_length).bit_length()
+    most_shared = max(len(shared) for shared in self.page_shared)
+    shared_id_bits = (len(shared_ids) - 1).bit_length() if shared_ids else 0
+
+    # Page offset hint table: header, then each item for all pages in turn;
+    # content stream offsets/lengths are given as whole pages, as readers ignore them
+    for value, width in ((least_count, 32), (first_page_location, 32), (count_bits, 16), (least_length, 32),
+                         (length_bits, 16), (0, 32), (0, 16), (least_length, 32), (length_bits, 16),
+                         (most_shared.bit_length(), 16), (shared_id_bits, 16), (0, 16), (0, 16)):
+      bits.write(value, width)
+    items = (
+      ([count - least_count for count in counts], count_bits),
+      ([length - least_length for length in page_lengths], length_bits),
+      ([len(shared) for shared in self.page_shared], most_shared.bit_length()),
+    )
+    for values, width in items:
+      for value in values:
+        bits.write(value, width)
+      bits.flush()
+    for shared in self.page_shared:  # Item 4, after items 1-3 above
+      for key in shared:
+        bits.write(shared_ids[key], shared_id_bits)
+    bits.flush()  # The numerators of item 5 and the content offsets of item 6 take 0 bits
+    for length in page_lengths:
+      bits.write(length - least_length, length_bits)
+    bits.flush()
+
+    # Shared object hint table: one entry per first-page object, then the shared objects
+    shared_table = len(bits.data)
+    least_shared = min(shared_lengths) if shared_lengths else 0
+    shared_length_bits = (max(shared_lengths) - least_shared).bit_length() if shared_lengths else 0
+    first_shared = self.numbers[self.shared[0]] if self.shared else 0
+    for value, width in ((first_shared, 32), (shared_location if self.shared else 0, 32),
+                         (len(self.first_page), 32), (len(shared_ids), 32), (0, 16),
+                         (least_shared, 32), (shared_length_bits, 16)):
+      bits.write(value, width)
+    for length in shared_lengths:
+      bits.write(length - least_shared, shared_length_bits)
+    bits.flush()
+    for _ in shared_lengths:
+      bits.write(0, 1)  # No MD5 signatures
+    bits.flush()  # Objects per group minus one takes 0 bits, groups are single objects
+
+    data = bytes(bits.data)
+    return (b"%d 0 obj\n<< /S %d /Length %d >>\nstream\n" % (self.hint_number, shared_table, len(data))
+            + data + b"\nendstream\nendobj\n")
+
+  def write(self, fp):
+    header = b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n"
+    with tempfile.TemporaryFile() as spool:
+      catalog = self._key(self.catalog_ref)
+      lengths = {key: self._spool(spool, key) for key in [catalog] + self.first_page}
+      for key in [key for page in self.pages[1:] for key in page] + self.shared + self.other:
+        lengths[key] = self._spool(spool, key)
+
+      lin_template = (b"%d 0 obj\n<< /Linearized 1 /L %-10d /H [ %-10d %-10d ] /O %d /E %-10d /N %d /T %-10d >>\n"
+                      b"endobj\n")
+      lin_length = len(lin_template % (self.lin_number, 0, 0, 0, self.numbers[self.first_page[0]], 0,
+                                       len(self.page_refs), 0))
+      first_xref = b"xref\n%d %d\n" % (self.lin_number, self.size - self.lin_number)
+      first_xref_length = len(first_xref) + len(XREF_ENTRY % 0) * (self.size - self.lin_number)
+      trailer_template = b"trailer\n<< /Size %d /Root %d 0 R /Prev %-10d >>\nstartxref\n0\n%%%%EOF\n"
+      trailer_length = len(trailer_template % (self.size, self.catalog_number, 0))
+
+      # Offsets without the hint stream, as the hint tables want them
+      offsets = {}
+      position = len(header) + lin_length + first_xref_length + trailer_length
+      hint_position = position + lengths[catalog]
+      for key in [catalog] + self.first_page + [key for page in self.pages[1:] for key in page] + self.shared + self.other:
+        offsets[key] = position
+        position += lengths[key]
+      page_lengths = [sum(lengths[key] for key in page) for page in self.pages]
+      shared_lengths = [lengths[key] for key in self.first_page + self.shared]
+      hint = self._hint_stream(page_lengths, offsets[self.first_page[0]], shared_lengths,
+                               offsets[self.shared[0]] if self.shared else 0)
+
+      hint_length = len(hint)
+      for key in offsets:
+        if key != catalog:
+          offsets[key] += hint_length
+      end_of_first_page = offsets[self.first_page[-1]] + lengths[self.first_page[-1]]
+      main_xref = position + hint_length
+      main_xref_head = b"xref\n0 %d\n" % (self.main_count + 1)
+      main_trailer = b"trailer\n<< /Size %d >>\nstartxref\n%d\n%%%%EOF\n"
+      file_length = (main_xref + len(main_xref_head) + len(FREE_ENTRY) * (self.main_count + 1)
+                     + len(main_trailer % (self.main_count + 1, len(header) + lin_length)))
+
+      fp.write(header)
+      fp.write(lin_template % (self.lin_number, file_length, hint_position, hint_length,
+                               self.numbers[self.first_page[0]], end_of_first_page, len(self.page_refs),
+                               main_xref + len(main_xref_head) - 1))
+      by_number = {number: offsets[key] for key, number in self.numbers.items()}
+      by_number[self.lin_number] = len(header)
+      by_number[self.hint_number] = hint_position
+      fp.write(first_xref)
+      fp.write(b"".join(XREF_ENTRY % by_number[number] for number in range(self.lin_number, self.size)))
+      fp.write(trailer_template % (self.size, self.catalog_number, main_xref))
+
+      spool.seek(0)
+      fp.write(spool.read(lengths[catalog]))
+      fp.write(hint)
+      while True:
+        chunk = spool.read(1 << 20)
+        if not chunk:
+          break
+        fp.write(chunk)
+
+      fp.write(main_xref_head)
+      fp.write(FREE_ENTRY)
+      fp.write(b"".join(XREF_ENTRY % by_number[number] for number in range(1, self.main_count + 1)))
+      fp.write(main_trailer % (self.main_count + 1, len(header) + lin_length))
+
+def linearize(pdf_path, output_path):
+  """Write pdf_path to output_path linearized ("fast web view").
+
+  The first page and everything it needs come right after the header, so
+  a viewer reading the file front to back (or by range requests) can show
+  page 1 before the rest has arrived. Objects are written uncompressed
+  (no object streams), as the hint tables address them individually.
+  """
+  from PyPDF2 import PdfReader
+  with open(pdf_path, "rb") as source:
+    linearizer = _Linearizer(PdfReader(source))
+    linearizer.plan()
+    with open(output_path, "wb") as fp:
+      linearizer.write(fp)
@@ -0,0 +1,63 @@
+# coding: utf8
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+class PhaseMetrics:
+  """Wall time, CPU time, peak traced memory, pages and bytes per generate() phase.
+
+  A phase can be entered many times (merging and numbering alternate per
+  segment): times and counts add up and the memory peak is the highest
+  seen. Memory is only traced with trace_memory, since tracemalloc makes
+  every allocation several times slower; without it the peak is None.
+  """
+
+  def __init__(self, trace_memory=False):
+    self.phases = {}
+    self.conversions = {}
+    self.started = time.perf_counter()
+    self.started_cpu = time.process_time()
+    self.own_trace = trace_memory and not tracemalloc.is_tracing()
+    self.trace_memory = trace_memory
+    if self.own_trace:
+      tracemalloc.start()
+
+  @contextmanager
+  def phase(self, name):
+    """Measure a block as part of phase name; yields the phase record for pages/bytes counts"""
+    record = self.phases.get(name)
+    if record is None:
+      record = self.phases[name] = {"seconds": 0.0, "cpuSeconds": 0.0, "peakTracedBytes": None, "pages": 0, "bytes": 0}
+    if self.trace_memory:
+      tracemalloc.reset_peak()
+    start, start_cpu = time.perf_counter(), time.process_time()
+    try:
+      yield record
+    finally:
+      record["seconds"] += time.perf_counter() - start
+      record["cpuSeconds"] += time.process_time() - start_cpu
+      if self.trace_memory:
+        record["peakTracedBytes"] = max(record["peakTracedBytes"] or 0, tracemalloc.get_traced_memory()[1])
+
+  def conversion(self, label, size, cache, seconds=0.0, cpu_seconds=0.0):
+    """A Word file's conversion, timed in its worker process (Word's own CPU time isn't included)"""
+    self.conversions[label] = {"file": label, "cache": cache, "seconds": seconds, "cpuSeconds": cpu_seconds,
+                               "peakTracedBytes": None, "pages": None, "bytes": size}
+
+  def conversion_pages(self, label, pages):
+    if label in self.conversions:
+      self.conversions[label]["pages"] = pages
+
+  def close(self):
+    if self.own_trace:
+      tracemalloc.stop()
+      self.own_trace = False
+
+  def report(self):
+    rounded = lambda record: {key: round(value, 4) if isinstance(value, float) else value for key, value in record.items()}
+    return {
+      "seconds": round(time.perf_counter() - self.started, 4),
+      "cpuSeconds": round(time.process_time() - self.started_cpu, 4),
+      "phases": {name: rounded(record) for name, record in self.phases.items()},
+      "conversions": [rounded(record) for record in self.conversions.values()],
+    }
@@ -0,0 +1,94 @@
+# coding: utf8
+import io
+
+from PyPDF2 import PdfReader
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject, NameObject
+
+NUMBER_FONT = "/DinDocsNum"
+DRAFT_IMAGE = "/DinDocsDraft"
+
+_draft_images = {}
+
+def _stream(data):
+  stream = DecodedStreamObject()
+  stream.set_data(data)
+  return stream
+
+def draft_image(draft_path):
+  """Render the draft watermark once per process and return its image XObject"""
+  image = _draft_images.get(draft_path)
+  if image is None:
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import A4
+    packet = io.BytesIO()
+    can = canvas.Canvas(packet, pagesize=A4)
+    page_width, page_height = A4
+    can.drawImage(draft_path, x=0, y=0, width=page_width, height=page_height, mask='auto')
+    can.save()
+    packet.seek(0)
+    xobjects = PdfReader(packet).pages[0]["/Resources"]["/XObject"]
+    image = list(xobjects.values())[0].get_object()
+    _draft_images[draft_path] = image
+  return image
+
+class PageStamper:
+  """Stamp page numbers and the draft watermark onto writer pages.
+
+  The font and the watermark image are added to the writer once and every
+  page references them; each page only gets a small content stream built
+  from a cached template.
+  """
+
+  def __init__(self, writer, draft_path=None):
+    self.writer = writer
+    font = DictionaryObject({
+      NameObject("/Type"): NameObject("/Font"),
+      NameObject("/Subtype"): NameObject("/Type1"),
+      NameObject("/BaseFont"): NameObject("/Helvetica"),
+      NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+    })
+    self.resources = [("/Font", NUMBER_FONT, writer._add_object(font))]
+    self.prefix = writer._add_object(_stream(b"q\n"))
+
+    template = b"Q\nBT " + NUMBER_FONT.encode() + b" 12 Tf 1 0 0 1 280 20 Tm (- %d -) Tj ET\n"
+    if draft_path:
+      from reportlab.lib.pagesizes import A4
+      image = draft_image(draft_path)
+      if getattr(writer, "streaming", False):
+        image = writer._add_object(image)  # Written out (with its mask) right away
+      else:
+        image = image.clone(writer).indirect_reference
+      self.resources.append(("/XObject", DRAFT_IMAGE, image))
+      page_width, page_height = A4
+      template += b"q\n%.4f 0 0 %.4f 0 0 cm\n" % (page_width, page_height) + DRAFT_IMAGE.encode() + b" Do\nQ\n"
+    self.template = template
+
+  def stamp(self, page, index):
+    """Append the page number (and watermark) overlay to a writer page"""
+    resources = page.raw_get("/Resources") if "/Resources" in page else None
+    if resources is None:
+      resources = DictionaryObject()
+      page[NameObject("/Resources")] = resources
+    else:
+      resources = resources.get_object()
+    for category, name, ref in self.resources:
+      entries = resources.raw_get(category) if category in resources else None
+      if entries is None:
+        entries = DictionaryObject()
+        resources[NameObject(category)] = entries
+      else:
+        entries = entries.get_object()
+      entries[NameObject(name)] = ref
+
+    contents = ArrayObject([self.prefix])
+    if "/Contents" in page:
+      current = page.raw_get("/Contents")
+      if isinstance(current.get_object(), ArrayObject):
+        contents.extend(current.get_object())
+      elif isinstance(current, IndirectObject):
+        contents.append(current)
+      else:
+        contents.append(self.writer._add_object(current))
+    contents.append(self.writer._add_object(_stream(self.template % index)))
+    page[NameObject("/Contents")] = contents
+    return page
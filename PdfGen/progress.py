@@ -0,0 +1,90 @@
+# coding: utf8
+import os
+import json
+import time
+import threading
+
+PROGRESS_INTERVAL = 0.1  # Seconds between two updates of the same phase (10/s)
+
+def pipe_writer(fd):
+  """Sink writing each status as one NDJSON line to a pipe file descriptor"""
+  def write(status):
+    os.write(fd, (json.dumps(status) + "\n").encode("utf-8"))
+  return write
+
+class ProgressChannel:
+  """Throttled progress messages, delivered to a sink by a background thread.
+
+  A status that changes the phase is always delivered, after the update
+  still pending for the previous phase. Otherwise at most one status per
+  interval goes out; updates in between are coalesced into the latest,
+  which is delivered once the interval has passed (or on close). The sink runs on a daemon thread, so
+  a slow or stuck reader never stalls generation.
+  """
+
+  def __init__(self, sink, interval=PROGRESS_INTERVAL):
+    self.sink = sink
+    self.interval = interval
+    self.queue = []
+    self.latest = None
+    self.phase = None  # Phase of the last status queued for delivery
+    self.sent_at = 0.0
+    self.closed = False
+    self.failed = False
+    self.condition = threading.Condition()
+    self.thread = threading.Thread(target=self._run, name="progress", daemon=True)
+    self.thread.start()
+
+  def send(self, status):
+    with self.condition:
+      now = time.monotonic()
+      phase = status.get("phase")
+      if phase != self.phase or now - self.sent_at >= self.interval:
+        if phase != self.phase and self.latest is not None:
+          self.queue.append(self.latest)
+        self.queue.append(status)
+        self.latest = None
+        self.phase = phase
+        self.sent_at = now
+        self.condition.notify()
+      else:
+        self.latest = status
+
+  def _next(self):
+    """Wait for the statuses due for delivery; None once closed and drained"""
+    with self.condition:
+      while not self.queue:
+        if self.latest is not None:
+          wait = self.sent_at + self.interval - time.monotonic()
+          if wait <= 0 or self.closed:
+            self.queue.append(self.latest)
+            self.latest = None
+            self.sent_at = time.monotonic()
+            break
+          self.condition.wait(wait)
+        elif self.closed:
+          return None
+        else:
+          self.condition.wait()
+      statuses, self.queue = self.queue, []
+      return statuses
+
+  def _run(self):
+    while True:
+      statuses = self._next()
+      if statuses is None:
+        return
+      if self.failed:
+        continue  # The reader is gone; keep draining so close() returns
+      try:
+        for status in statuses:
+          self.sink(status)
+      except (OSError, ValueError):
+        self.failed = True
+
+  def close(self, timeout=5):
+    """Deliver the last coalesced status and wait for the writer to finish"""
+    with self.condition:
+      self.closed = True
+      self.condition.notify()
+    self.thread.join(timeout)
@@ -1,6 +1,5 @@
 import path from 'path';
 import isDev from 'electron-is-dev';
-import net from 'net';
 import { fileURLToPath } from 'url';
 import { spawn } from 'child_process';
 
@@ -9,31 +8,69 @@ const __dirname = path.dirname(__filename);
 
 const executablePath = path.join(__dirname, isDev ? '' : '../', '../srv/PdfGen.exe');
 //const executablePath = path.join(__dirname, isDev ? '' : '../', '../PdfGen/PdfGen.py');
-const PIPE_PATH = "\\\\.\\pipe\\pdfpipe";
 
-function generate(mainWindow, files) {
-	files = typeof files === 'string' ? files : JSON.stringify(files)
-  const app = spawn(executablePath, [files]);
-  //const app = spawn('python', [executablePath, files]);
+// PdfGen runs as a resident worker: jobs go to its stdin and progress/results
+// come back on stdout, one JSON message per line, tagged with the job id
+let worker = null;
+let output = '';
+let nextJobId = 0;
+const jobs = new Map();
 
-  app.stdout.on('data', data => {
-    mainWindow.webContents.send("pdfGenFinished", {detail: JSON.parse(data.toString())});
-  });
+function startWorker() {
+  // stderr only carries library warnings; left piped and unread it would fill
+  // up and block the resident worker on its next write
+  worker = spawn(executablePath, ['--worker'], { stdio: ['pipe', 'pipe', 'ignore'] });
+  //worker = spawn('python', [executablePath, '--worker'], { stdio: ['pipe', 'pipe', 'ignore'] });
+  worker.stdout.setEncoding('utf8');
 
-  const server = net.createServer(function (stream) {
-    stream.on('data', function (data) {
-      mainWindow.webContents.send("pdfGenStatus", {detail: JSON.parse(data.toString())});
-    });
+  worker.stdout.on('data', data => {
+    output += data;
+    let newline;
+    while ((newline = output.indexOf('\n')) >= 0) {
+      const line = output.slice(0, newline).trim();
+      output = output.slice(newline + 1);
+      if (!line) continue;
 
-    stream.on('end', function () {
-      server.close();
-    });
+      let message;
+      try {
+        message = JSON.parse(line);
+      } catch {
+        continue; // Not a protocol line (e.g. a library warning on stdout)
+      }
+      const mainWindow = jobs.get(message.id);
+      if (!mainWindow) continue;
+      if (message.type === 'status') {
+        mainWindow.webContents.send("pdfGenStatus", {detail: message});
+      } else if (message.type === 'result') {
+        jobs.delete(message.id);
+        mainWindow.webContents.send("pdfGenFinished", {detail: message.result});
+      }
+    }
   });
 
-  server.listen(PIPE_PATH);
+  worker.on('exit', stopWorker);
+  worker.on('error', stopWorker);
+  worker.stdin.on('error', () => {}); // A dead worker is reported through 'exit'
+}
+
+function stopWorker() {
+  worker = null;
+  output = '';
+  for (const mainWindow of jobs.values()) {
+    mainWindow.webContents.send("pdfGenFinished", {detail: {status: 'error', msg: 'תקלה בתהליך יצירת המסמך'}});
+  }
+  jobs.clear();
+}
+
+function generate(mainWindow, files) {
+  const docs = typeof files === 'string' ? JSON.parse(files) : files;
+  if (!worker) startWorker();
+
+  const id = ++nextJobId;
+  jobs.set(id, mainWindow);
+  worker.stdin.write(JSON.stringify({ id, docs }) + '\n');
 }
 
 export default {
   generate
 };
-